@@ -1,5 +1,11 @@
 /* global $ */
 
+import * as msgpack from "./msgpack";
+
+// Subprotocols in order of preference.  The server falls back to JSON
+// for clients that don't ask for one.
+const SUBPROTOCOLS = ["chat.msgpack", "chat.json"];
+
 const ESCAPES = {
   "&": "&amp",
   "<": "&lt",
@@ -13,18 +19,33 @@ function escape(s) {
 }
 
 function capitalize(s) {
-  return s[0].toUpperCase() + s.slice(1);
+  return s
+    .split("_")
+    .map(word => word[0].toUpperCase() + word.slice(1))
+    .join("");
 }
 
 function JsonMessage(data) {
   return JSON.stringify(data);
 }
 
+function encodeMessage(protocol, data) {
+  return protocol === "chat.msgpack" ? msgpack.encode(data) : JsonMessage(data);
+}
+
+function decodeMessage(data) {
+  return typeof data === "string" ? JSON.parse(data) : msgpack.decode(data);
+}
+
 class ChatController {
   constructor(messagingController, membersController) {
     this.messagingController = messagingController;
     this.membersController = membersController;
 
+    // Event ids are per room, so the last one seen is kept for every
+    // room in order to be able to resume any of them.
+    this.lastEventIds = {};
+
     this.connect();
     this.pingInterval = window.setInterval(this.sendPing.bind(this), 10000);
     this.reconnectInterval = window.setInterval(
@@ -34,8 +55,10 @@ class ChatController {
   }
 
   connect() {
-    const URI = window.location.origin.replace("http", "ws") + "/v1/chat";
-    this.sock = new WebSocket(URI);
+    // Opt into having bursts of events batched into a single frame.
+    const URI = window.location.origin.replace("http", "ws") + "/v1/chat?batch=1";
+    this.sock = new WebSocket(URI, SUBPROTOCOLS);
+    this.sock.binaryType = "arraybuffer";
     this.sock.onopen = this.onSocketOpened.bind(this);
     this.sock.onclose = this.onSocketClosed.bind(this);
     this.sock.onerror = this.onSocketError.bind(this);
@@ -49,27 +72,39 @@ class ChatController {
     }
   }
 
+  send(data) {
+    this.sock.send(encodeMessage(this.sock.protocol, data));
+  }
+
   sendMessage(message) {
-    this.sock.send(
-      JsonMessage({ type: "message", room_name: this.currentRoom, message })
-    );
+    this.send({ type: "message", room_name: this.currentRoom, message });
   }
 
   sendPing() {
     if (this.sock.readyState === 1) {
-      this.sock.send(
-        JsonMessage({ type: "ping", room_name: this.currentRoom })
-      );
+      this.send({ type: "ping", room_name: this.currentRoom });
     }
   }
 
   onRoomChanged(roomName) {
+    // Events aren't tagged with their room, so we stop listening to
+    // the previous room to keep its events from being taken for the
+    // new one's.
+    if (this.currentRoom !== undefined && this.currentRoom !== roomName) {
+      this.send({ type: "leave", room_name: this.currentRoom });
+    }
+
     this.currentRoom = roomName;
-    this.sock.send(JsonMessage({ type: "join", room_name: roomName }));
+    this.send({
+      type: "join",
+      room_name: roomName,
+      presence: "delta",
+      resume_from: this.lastEventIds[roomName]
+    });
   }
 
   onSocketOpened() {
-    this.onRoomChanged("general");
+    this.onRoomChanged(this.currentRoom || "general");
     this.messagingController.addStatusMessage("You are connected.");
   }
 
@@ -80,10 +115,33 @@ class ChatController {
   onSocketError() {}
 
   onSocketMessage(message) {
-    const data = JSON.parse(message.data);
+    const data = decodeMessage(message.data);
+    if (Array.isArray(data)) {
+      data.forEach(event => this.onEvent(event));
+    } else {
+      this.onEvent(data);
+    }
+  }
+
+  onEvent(data) {
+    if (data.id !== undefined) {
+      // Events replayed after a reconnect may also arrive live.
+      if (data.id <= this.lastEventIds[this.currentRoom]) {
+        return;
+      }
+
+      this.lastEventIds[this.currentRoom] = data.id;
+    }
+
     this[`on${capitalize(data.type)}Event`](data);
   }
 
+  onResumeEvent({ ok, last_event_id }) {
+    if (!ok) {
+      this.lastEventIds[this.currentRoom] = last_event_id;
+    }
+  }
+
   onJoinEvent({ username }) {
     this.messagingController.addStatusMessage(
       `${username} has joined the room.`
@@ -100,11 +158,56 @@ class ChatController {
     usernames.forEach(username => this.membersController.addMember(username));
   }
 
+  onPresenceSnapshotEvent({ version, usernames }) {
+    this.presenceVersion = version;
+    this.membersController.setMembers(usernames);
+  }
+
+  onPresenceDeltaEvent({ version, added, removed }) {
+    if (version <= this.presenceVersion) {
+      return;
+    }
+
+    this.presenceVersion = version;
+    added.forEach(username => this.membersController.addMember(username));
+    removed.forEach(username => this.membersController.removeMember(username));
+  }
+
+  onPresenceCountEvent() {}
+
   onPongEvent() {}
 
+  onRateLimitedEvent({ event, room_name, retry_after }) {
+    // Pings are sent in the background, so being limited on them
+    // isn't worth telling anyone about.
+    const seconds = Math.ceil(retry_after / 1000);
+    if (event === "message") {
+      this.messagingController.addStatusMessage(
+        `You're sending messages too quickly. Try again in ${seconds}s.`
+      );
+    } else if (event === "join") {
+      this.messagingController.addStatusMessage(
+        `You're switching rooms too quickly. Joining again in ${seconds}s.`
+      );
+
+      // Only retry if we haven't moved on to another room since.
+      window.setTimeout(() => {
+        if (room_name === this.currentRoom && this.sock.readyState === 1) {
+          this.onRoomChanged(room_name);
+        }
+      }, retry_after);
+    }
+  }
+
   onBroadcastEvent({ username, message }) {
     this.messagingController.addMessage(username, message);
   }
+
+  onHistoryEvent({ messages }) {
+    messages.forEach(({ username, message }) =>
+      this.messagingController.addMessage(username, message)
+    );
+  }
 }
 
 class MessagingController {
@@ -147,6 +250,11 @@ class MembersController {
     this.members = [];
   }
 
+  setMembers(usernames) {
+    this.members = usernames.slice();
+    this.render();
+  }
+
   addMember(username) {
     if (this.members.indexOf(username) === -1) {
       this.members.push(username);
@@ -0,0 +1,167 @@
+// A minimal MessagePack codec covering the types the chat protocol
+// uses: nil, booleans, numbers, strings, arrays and maps.
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+class Writer {
+  constructor() {
+    this.bytes = [];
+  }
+
+  byte(b) {
+    this.bytes.push(b & 0xff);
+  }
+
+  uint(n, size) {
+    for (let shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+      this.byte(Math.floor(n / Math.pow(2, shift)));
+    }
+  }
+
+  float64(n) {
+    const view = new DataView(new ArrayBuffer(8));
+    view.setFloat64(0, n);
+    this.byte(0xcb);
+    for (let i = 0; i < 8; i++) {
+      this.byte(view.getUint8(i));
+    }
+  }
+
+  header(length, fix, fixMax, codes) {
+    if (length <= fixMax) {
+      this.byte(fix | length);
+    } else if (codes[0] && length <= 0xff) {
+      this.byte(codes[0]);
+      this.uint(length, 1);
+    } else if (length <= 0xffff) {
+      this.byte(codes[1]);
+      this.uint(length, 2);
+    } else {
+      this.byte(codes[2]);
+      this.uint(length, 4);
+    }
+  }
+
+  value(value) {
+    if (value === null || value === undefined) {
+      this.byte(0xc0);
+    } else if (value === false || value === true) {
+      this.byte(value ? 0xc3 : 0xc2);
+    } else if (typeof value === "number") {
+      if (Number.isInteger(value) && value >= 0 && value <= 0xffffffff) {
+        if (value < 0x80) {
+          this.byte(value);
+        } else {
+          this.byte(0xce);
+          this.uint(value, 4);
+        }
+      } else if (Number.isInteger(value) && value < 0 && value >= -32) {
+        this.byte(value);
+      } else {
+        this.float64(value);
+      }
+    } else if (typeof value === "string") {
+      const bytes = textEncoder.encode(value);
+      this.header(bytes.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+      bytes.forEach(b => this.byte(b));
+    } else if (Array.isArray(value)) {
+      this.header(value.length, 0x90, 15, [null, 0xdc, 0xdd]);
+      value.forEach(item => this.value(item));
+    } else {
+      const keys = Object.keys(value).filter(key => value[key] !== undefined);
+      this.header(keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+      keys.forEach(key => {
+        this.value(key);
+        this.value(value[key]);
+      });
+    }
+  }
+}
+
+class Reader {
+  constructor(buffer) {
+    this.view = new DataView(buffer);
+    this.offset = 0;
+  }
+
+  uint(size) {
+    let n = 0;
+    for (let i = 0; i < size; i++) {
+      n = n * 256 + this.view.getUint8(this.offset++);
+    }
+    return n;
+  }
+
+  int(size) {
+    const n = this.uint(size);
+    const limit = Math.pow(2, size * 8);
+    return n >= limit / 2 ? n - limit : n;
+  }
+
+  str(length) {
+    const bytes = new Uint8Array(this.view.buffer, this.offset, length);
+    this.offset += length;
+    return textDecoder.decode(bytes);
+  }
+
+  array(length) {
+    const items = [];
+    for (let i = 0; i < length; i++) {
+      items.push(this.value());
+    }
+    return items;
+  }
+
+  map(length) {
+    const items = {};
+    for (let i = 0; i < length; i++) {
+      const key = this.value();
+      items[key] = this.value();
+    }
+    return items;
+  }
+
+  value() {
+    const code = this.uint(1);
+    if (code < 0x80) return code;
+    if (code < 0x90) return this.map(code & 0x0f);
+    if (code < 0xa0) return this.array(code & 0x0f);
+    if (code < 0xc0) return this.str(code & 0x1f);
+    if (code >= 0xe0) return code - 0x100;
+
+    switch (code) {
+    case 0xc0: return null;
+    case 0xc2: return false;
+    case 0xc3: return true;
+    case 0xca: this.offset += 4; return this.view.getFloat32(this.offset - 4);
+    case 0xcb: this.offset += 8; return this.view.getFloat64(this.offset - 8);
+    case 0xcc: return this.uint(1);
+    case 0xcd: return this.uint(2);
+    case 0xce: return this.uint(4);
+    case 0xcf: return this.uint(8);
+    case 0xd0: return this.int(1);
+    case 0xd1: return this.int(2);
+    case 0xd2: return this.int(4);
+    case 0xd3: return this.int(8);
+    case 0xd9: return this.str(this.uint(1));
+    case 0xda: return this.str(this.uint(2));
+    case 0xdb: return this.str(this.uint(4));
+    case 0xdc: return this.array(this.uint(2));
+    case 0xdd: return this.array(this.uint(4));
+    case 0xde: return this.map(this.uint(2));
+    case 0xdf: return this.map(this.uint(4));
+    default: throw new Error(`Unsupported MessagePack type 0x${code.toString(16)}.`);
+    }
+  }
+}
+
+export function encode(value) {
+  const writer = new Writer();
+  writer.value(value);
+  return new Uint8Array(writer.bytes);
+}
+
+export function decode(buffer) {
+  return new Reader(buffer).value();
+}
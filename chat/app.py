@@ -1,22 +1,30 @@
 from typing import Optional
 
-from molten import App, Include, ResponseRendererMiddleware, Route, SettingsComponent, redirect
+from molten import HTTP_200, App, Include, Response, ResponseRendererMiddleware, Route, SettingsComponent, redirect
 from molten.contrib.request_id import RequestIdMiddleware
 from molten.contrib.sessions import CookieStore, SessionComponent, SessionMiddleware
 from molten.contrib.sqlalchemy import SQLAlchemyEngineComponent, SQLAlchemyMiddleware, SQLAlchemySessionComponent
 from molten.contrib.templates import Templates, TemplatesComponent
-from molten.contrib.websockets import WebsocketsMiddleware
 from molten.openapi import Metadata, OpenAPIHandler, OpenAPIUIHandler
 from whitenoise import WhiteNoise
 
 from . import settings
 from .common import path_to
-from .components.accounts import Account, AccountManagerComponent, CurrentAccountComponent
+from .components.accounts import (
+    Account, AccountCacheComponent, AccountManagerComponent, CredentialCacheComponent, CurrentAccountComponent,
+    CurrentIdentityComponent
+)
 from .components.chatrooms import ChatHandlerFactoryComponent, ChatroomListenerComponent, ChatroomRegistryComponent
+from .components.events import RoomEventsComponent
+from .components.history import RoomHistoryComponent
 from .components.passwords import PasswordHasherComponent
+from .components.ratelimits import RateLimiterComponent
 from .components.redis import RedisComponent
+from .components.sweeper import PresenceSweeperComponent
 from .handlers import accounts, chat, sessions
 from .logging import setup_logging
+from .metrics import CONTENT_TYPE, METRICS
+from .websockets import ChatWebsocketsMiddleware
 
 
 def index(account: Optional[Account], templates: Templates):
@@ -33,6 +41,10 @@ def register(templates: Templates):
     return templates.render("register.html")
 
 
+def get_metrics():
+    return Response(HTTP_200, headers={"content-type": CONTENT_TYPE}, content=METRICS.render())
+
+
 def setup_app():
     setup_logging()
 
@@ -50,13 +62,20 @@ def setup_app():
 
     app = App(
         components=[
+            AccountCacheComponent(),
             AccountManagerComponent(),
             ChatHandlerFactoryComponent(),
             ChatroomListenerComponent(),
             ChatroomRegistryComponent(),
+            CredentialCacheComponent(),
             CurrentAccountComponent(),
+            CurrentIdentityComponent(),
             PasswordHasherComponent(),
+            PresenceSweeperComponent(),
+            RateLimiterComponent(),
             RedisComponent(),
+            RoomEventsComponent(),
+            RoomHistoryComponent(),
             SQLAlchemyEngineComponent(),
             SQLAlchemySessionComponent(),
             SessionComponent(cookie_store),
@@ -68,13 +87,14 @@ def setup_app():
             RequestIdMiddleware(),
             SessionMiddleware(cookie_store),
             ResponseRendererMiddleware(),
-            WebsocketsMiddleware(),
+            ChatWebsocketsMiddleware(),
             SQLAlchemyMiddleware(),
         ],
 
         routes=[
             Route("/_schema", get_schema),
             Route("/_docs", get_docs),
+            Route("/_metrics", get_metrics),
             Route("/", index),
             Route("/login", login),
             Route("/register", register),
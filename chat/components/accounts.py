@@ -1,15 +1,24 @@
 import base64
+import hashlib
+import hmac
+import json
+import secrets
+import time
+from collections import OrderedDict
+from threading import Lock
 from typing import Optional
 
-from molten import Header
+from molten import DependencyResolver, Header, Settings
 from molten.contrib.sessions import Session
 from molten.contrib.sqlalchemy import Session as DBSession
 from molten.typing import extract_optional_annotation
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.exc import IntegrityError
 
+from ..metrics import METRICS
 from ..models import Manager, Model
 from .passwords import PasswordHasher
+from .redis import Redis
 
 
 class Account(Model):
@@ -20,6 +29,37 @@ class Account(Model):
     password_hash = Column(String, nullable=False)
 
 
+class Identity:
+    """Who's behind a request, as far as can be told without going to
+    the database.
+    """
+
+    __slots__ = ["id", "username"]
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+
+def store_identity(session, account, ttl):
+    """Remember an account's identity in a session for *ttl* seconds.
+    Sessions are signed so clients can read but not forge identities.
+    """
+    session["identity"] = {
+        "id": account.id,
+        "username": account.username,
+        "expires_at": int(time.time() + ttl),
+    }
+
+
+def load_identity(session):
+    identity = session.get("identity")
+    if not identity or identity["expires_at"] <= time.time():
+        return None
+
+    return Identity(identity["id"], identity["username"])
+
+
 class AccountError(Exception):
     pass
 
@@ -28,25 +68,275 @@ class UsernameTaken(AccountError):
     pass
 
 
+def credential_version_key(username):
+    return f"chat:credentials:{username}"
+
+
+class CredentialCache:
+    """A bounded, per-worker LRU cache of recently verified Basic auth
+    credentials.  Entries are keyed by an HMAC of the credentials,
+    using a key that never leaves the process, so that passwords
+    aren't kept around in memory.  Entries expire after *ttl* seconds.
+
+    Each username has a credential version in Redis that gets bumped
+    whenever its password changes.  Entries are only used while the
+    version they were verified under is current, so a password change
+    on one worker invalidates the entries of every other worker.
+    """
+
+    __slots__ = ["entries", "key", "max_size", "mutex", "redis", "ttl"]
+
+    def __init__(self, redis, max_size, ttl):
+        self.entries = OrderedDict()
+        self.key = secrets.token_bytes(32)
+        self.max_size = max_size
+        self.mutex = Lock()
+        self.redis = redis
+        self.ttl = ttl
+
+    def digest(self, username, password):
+        return hmac.new(self.key, f"{username}:{password}".encode(), hashlib.sha256).digest()
+
+    def get(self, username, password):
+        """Get a detached copy of the account the credentials were
+        verified against, if they were verified recently enough, along
+        with the username's current credential version.  The version
+        must be passed to put() if the credentials get verified.
+        """
+        version = int(self.redis.get(credential_version_key(username)) or 0)
+        digest = self.digest(username, password)
+        with self.mutex:
+            try:
+                _, account_id, entry_version, expires_at = self.entries[digest]
+            except KeyError:
+                return None, version
+
+            if entry_version != version or expires_at <= time.monotonic():
+                del self.entries[digest]
+                return None, version
+
+            self.entries.move_to_end(digest)
+
+        return Account(id=account_id, username=username), version
+
+    def put(self, username, password, account, version):
+        digest = self.digest(username, password)
+        with self.mutex:
+            self.entries[digest] = (username, account.id, version, time.monotonic() + self.ttl)
+            self.entries.move_to_end(digest)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        """Forget every verified password for the given username on
+        every worker.
+        """
+        # The version only needs to outlive the entries verified under
+        # the previous one.  Once it expires, versions start back at 0.
+        with self.redis.pipeline() as pipeline:
+            pipeline.incr(credential_version_key(username))
+            pipeline.pexpire(credential_version_key(username), int(self.ttl * 1000))
+            pipeline.execute()
+
+        with self.mutex:
+            for digest, (entry_username, _, _, _) in list(self.entries.items()):
+                if entry_username == username:
+                    del self.entries[digest]
+
+
+class CredentialCacheComponent:
+    is_cacheable = True
+    is_singleton = True
+
+    def can_handle_parameter(self, parameter):
+        return parameter.annotation is CredentialCache
+
+    def resolve(self, redis: Redis, settings: Settings):
+        return CredentialCache(
+            redis,
+            max_size=settings.strict_get("accounts.credential_cache_size"),
+            ttl=settings.strict_get("accounts.credential_cache_ttl"),
+        )
+
+
+def account_cache_key(account_id):
+    return f"chat:accounts:{account_id}"
+
+
+class AccountCacheCounters:
+    """Per-worker counts of account cache lookups.
+    """
+
+    __slots__ = ["evictions", "hits", "misses", "shared_hits"]
+
+    def __init__(self):
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+
+
+class AccountCache:
+    """A bounded, per-worker read-through cache of account rows.  When
+    given a Redis client, rows are also shared between workers through
+    Redis so that each one doesn't have to hit the database on its own.
+
+    Only ids and usernames are cached, so accounts handed out by the
+    cache can't be used to check passwords.
+    """
+
+    __slots__ = ["counters", "entries", "max_size", "mutex", "redis", "ttl"]
+
+    def __init__(self, redis, max_size, ttl):
+        self.counters = AccountCacheCounters()
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.mutex = Lock()
+        self.redis = redis
+        self.ttl = ttl
+
+    def export_metrics(self):
+        """Export this cache's counters through the worker's metrics.
+        Only the worker's own cache should export them.
+        """
+        METRICS.callback(
+            "chat_account_cache_hits_total",
+            "The number of accounts found in this worker's account cache.",
+            lambda: self.counters.hits, kind="counter",
+        )
+        METRICS.callback(
+            "chat_account_cache_shared_hits_total",
+            "The number of accounts found in the account cache shared between workers.",
+            lambda: self.counters.shared_hits, kind="counter",
+        )
+        METRICS.callback(
+            "chat_account_cache_misses_total",
+            "The number of accounts that had to be loaded from the database.",
+            lambda: self.counters.misses, kind="counter",
+        )
+        METRICS.callback(
+            "chat_account_cache_evictions_total",
+            "The number of accounts dropped from this worker's account cache to make room for others.",
+            lambda: self.counters.evictions, kind="counter",
+        )
+        METRICS.callback(
+            "chat_account_cache_entries",
+            "The number of accounts in this worker's account cache.",
+            lambda: len(self.entries),
+        )
+
+    def get(self, account_id, load):
+        """Get an account by id, calling *load* to fetch it from the
+        database if it's not in the cache.
+        """
+        with self.mutex:
+            try:
+                row, expires_at = self.entries[account_id]
+                if expires_at > time.monotonic():
+                    self.entries.move_to_end(account_id)
+                    self.counters.hits += 1
+                    return Account(**row)
+
+                del self.entries[account_id]
+            except KeyError:
+                pass
+
+        if self.redis is not None:
+            data = self.redis.get(account_cache_key(account_id))
+            if data is not None:
+                row = json.loads(data)
+                self.store(account_id, row)
+                self.counters.shared_hits += 1
+                return Account(**row)
+
+        self.counters.misses += 1
+        account = load(account_id)
+        if account is None:
+            return None
+
+        row = {"id": account.id, "username": account.username}
+        self.store(account_id, row)
+        if self.redis is not None:
+            self.redis.set(account_cache_key(account_id), json.dumps(row), px=int(self.ttl * 1000))
+
+        return account
+
+    def store(self, account_id, row):
+        with self.mutex:
+            self.entries[account_id] = (row, time.monotonic() + self.ttl)
+            self.entries.move_to_end(account_id)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters.evictions += 1
+
+    def invalidate(self, account_id):
+        """Drop an account from this worker's cache and the shared
+        one.  Other workers may hold on to their copy until it expires.
+        """
+        with self.mutex:
+            self.entries.pop(account_id, None)
+
+        if self.redis is not None:
+            self.redis.delete(account_cache_key(account_id))
+
+
+class AccountCacheComponent:
+    is_cacheable = True
+    is_singleton = True
+
+    def can_handle_parameter(self, parameter):
+        return parameter.annotation is AccountCache
+
+    def resolve(self, redis: Redis, settings: Settings):
+        account_cache = AccountCache(
+            redis if settings.strict_get("accounts.account_cache_shared") else None,
+            max_size=settings.strict_get("accounts.account_cache_size"),
+            ttl=settings.strict_get("accounts.account_cache_ttl"),
+        )
+        account_cache.export_metrics()
+        return account_cache
+
+
 class AccountManager(Manager):
-    __slots__ = ["password_hasher", "session"]
+    __slots__ = ["account_cache", "credential_cache", "password_hasher", "session"]
 
-    def __init__(self, password_hasher: PasswordHasher, session: DBSession):
+    def __init__(
+            self,
+            password_hasher: PasswordHasher,
+            account_cache: AccountCache,
+            credential_cache: CredentialCache,
+            session: DBSession,
+    ):
         self.password_hasher = password_hasher
+        self.account_cache = account_cache
+        self.credential_cache = credential_cache
         self.session = session
 
     def create(self, username, password):
         try:
             account = Account(username=username)
-            account.password_hash = self.password_hasher.hash(password)
+            self.set_password(account, password)
             self.session.add(account)
             self.session.commit()
+            self.account_cache.invalidate(account.id)
             return account
         except IntegrityError:
             raise UsernameTaken()
 
+    def change_password(self, account, password):
+        # Accounts may come from the cache, so they have to be merged
+        # into the session before they can be updated.
+        account = self.session.merge(account)
+        self.set_password(account, password)
+        self.session.commit()
+        self.account_cache.invalidate(account.id)
+        self.credential_cache.invalidate(account.username)
+
+    def set_password(self, account, password):
+        account.password_hash = self.password_hasher.hash(password)
+
     def find_by_id(self, id):
-        return self.session.query(Account).get(id)
+        return self.account_cache.get(id, self.session.query(Account).get)
 
     def find_by_username(self, username):
         return self.session.query(Account).filter_by(username=username).first()
@@ -66,8 +356,14 @@ class AccountManagerComponent:
     def can_handle_parameter(self, parameter):
         return parameter.annotation is AccountManager
 
-    def resolve(self, password_hasher: PasswordHasher, session: DBSession):
-        return AccountManager(password_hasher, session)
+    def resolve(
+            self,
+            password_hasher: PasswordHasher,
+            account_cache: AccountCache,
+            credential_cache: CredentialCache,
+            session: DBSession,
+    ):
+        return AccountManager(password_hasher, account_cache, credential_cache, session)
 
 
 class CurrentAccountComponent:
@@ -78,14 +374,58 @@ class CurrentAccountComponent:
         _, annotation = extract_optional_annotation(parameter.annotation)
         return annotation is Account
 
-    def resolve(self, account_manager: AccountManager, authorization: Optional[Header], session: Session):
+    def resolve(
+            self,
+            account_manager: AccountManager,
+            credential_cache: CredentialCache,
+            authorization: Optional[Header],
+            session: Session,
+    ):
         if authorization is not None:
             sequence = authorization[len("Basic "):]
             username, _, password = base64.urlsafe_b64decode(sequence).decode().partition(":")
-            return account_manager.find_by_username_and_password(username, password)
+            # Hashing passwords is expensive and blocks the hub, so
+            # recently verified credentials skip both that and the
+            # account lookup.
+            account, version = credential_cache.get(username, password)
+            if account is None:
+                account = account_manager.find_by_username_and_password(username, password)
+                if account is not None:
+                    credential_cache.put(username, password, account, version)
+
+            return account
 
         account_id = session.get("account_id")
         if not account_id:
             return None
 
         return account_manager.find_by_id(account_id)
+
+
+class CurrentIdentityComponent:
+    is_cacheable = True
+    is_singleton = False
+
+    def can_handle_parameter(self, parameter):
+        _, annotation = extract_optional_annotation(parameter.annotation)
+        return annotation is Identity
+
+    def resolve(self, authorization: Optional[Header], session: Session, resolver: DependencyResolver):
+        if authorization is None:
+            identity = load_identity(session)
+            if identity is not None:
+                return identity
+
+        # Basic auth and sessions that predate identities fall back to
+        # looking the account up, but the DB session is closed right
+        # away since identities tend to be held onto by long-lived
+        # websocket handlers.
+        def find_account(account: Optional[Account], db_session: DBSession):
+            db_session.close()
+            return account
+
+        account = resolver.resolve(find_account)()
+        if account is None:
+            return None
+
+        return Identity(account.id, account.username)
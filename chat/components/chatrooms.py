@@ -1,75 +1,852 @@
 import json
 import logging
+import sys
 import time
 from collections import defaultdict
 from functools import partial
 from threading import Lock
+from uuid import uuid4
 
 import gevent
-from gevent import Timeout
-from molten.contrib.websockets import CloseMessage, TextMessage
+from gevent.event import Event
+from molten import Settings
+from molten.contrib.websockets import CloseMessage, WebsocketError
 
+from ..metrics import METRICS
+from ..relay import RelaySubscriber, unread_bytes
+from ..websockets import COUNTERS, OVERFLOW_POLICIES, Outbox, TimerWheel, WireMessage
+from .events import PUBLISH_FUNCTION, RoomEvents, replay_key, room_channel, sequence_key
+from .history import RoomHistory, history_key
+from .ratelimits import TAKE_TOKENS_FUNCTION, RateLimiter
 from .redis import Redis
 
 LOGGER = logging.getLogger(__name__)
 
+#: The number of seconds to wait for Redis to confirm a room subscription.
+SUBSCRIBE_TIMEOUT = 5
 
-def JsonMessage(**kwargs):
-    return TextMessage(json.dumps(kwargs))
+#: The number of seconds to wait before reading from a subscriber
+#: again after it first fails.  The delay doubles on every subsequent
+#: failure, up to RETRY_DELAY_MAX.
+RETRY_DELAY_MIN = 0.5
+
+#: The maximum number of seconds to wait between subscriber reads
+#: while it's down.
+RETRY_DELAY_MAX = 30
+
+#: The number of milliseconds after which a worker's claim on a room's
+#: next presence update expires, in case it dies before publishing it.
+PRESENCE_CLAIM_TTL = 10000
+
+#: The number of seconds after their last heartbeat that members are
+#: considered to have left a room.
+MEMBER_TTL = 60
+
+#: The number of milliseconds a departing member's marker outlives
+#: their grace period by, so that the worker that scheduled the
+#: departure is still able to claim it.
+DEPARTURE_MARGIN = 10000
+
+#: The set of rooms that have (or recently had) members.
+ACTIVE_ROOMS_KEY = "chat:active_rooms"
+
+#: Clients receive the complete member list whenever it changes.
+PRESENCE_FULL = "full"
+
+#: Clients receive a snapshot of the member list on join followed by
+#: versioned additions and removals.
+PRESENCE_DELTA = "delta"
+
+#: Clients only receive the member count and page through members
+#: over HTTP.  Meant for very large rooms.
+PRESENCE_COUNT = "count"
+
+#: The set of supported presence modes.
+PRESENCE_MODES = {PRESENCE_FULL, PRESENCE_DELTA, PRESENCE_COUNT}
+
+#: The types of events clients can send.
+EVENT_TYPES = ("history", "join", "leave", "message", "ping")
+
+#: The types of events whose rate limits are enforced by the same
+#: script that handles them rather than by a round trip of their own.
+SELF_LIMITED_EVENT_TYPES = {"message"}
+
+#: How long broadcasting a message to a room's local sockets takes.
+SEND_TO_ALL_SECONDS = METRICS.histogram(
+    "chat_send_to_all_seconds",
+    "The time it takes to queue a message up for every local socket in a room.",
+)
+
+#: How many sockets failed to accept a broadcast.
+SEND_TO_ALL_FAILURES = METRICS.counter(
+    "chat_send_to_all_failures_total",
+    "The number of times a socket failed to accept a broadcast or presence message.",
+)
+
+#: How long handling each type of client event takes.
+EVENT_HANDLING_SECONDS = METRICS.histogram(
+    "chat_event_handling_seconds",
+    "The time it takes to handle an event sent by a client, by event type.",
+    label="type", values=EVENT_TYPES,
+)
+
+#: The types of events rooms publish.
+ROOM_EVENT_TYPES = ("broadcast", "join", "leave", "presence")
+
+#: How long events take to get from the worker that published them to
+#: this worker.  Measured across hosts so it's subject to clock skew.
+PUBLISH_LAG_SECONDS = METRICS.histogram(
+    "chat_event_publish_lag_seconds",
+    "The time between an event being published and this worker receiving it, by event type.",
+    label="type", values=ROOM_EVENT_TYPES,
+)
+
+#: How long events take to get written to every local socket.
+DELIVERY_SECONDS = METRICS.histogram(
+    "chat_event_delivery_seconds",
+    "The time between this worker receiving an event and the last of its sockets being written to, by event type.",
+    label="type", values=ROOM_EVENT_TYPES,
+)
+
+METRICS.callback(
+    "chat_outbox_dead_peers_total",
+    "The number of connections dropped for not answering pings.",
+    lambda: COUNTERS.dead_peers, kind="counter",
+)
+METRICS.callback(
+    "chat_outbox_dropped_connections_total",
+    "The number of connections dropped for falling too far behind.",
+    lambda: COUNTERS.dropped_connections, kind="counter",
+)
+METRICS.callback(
+    "chat_outbox_dropped_messages_total",
+    "The number of messages dropped from full outboxes.",
+    lambda: COUNTERS.dropped_messages, kind="counter",
+)
+METRICS.callback(
+    "chat_outbox_failed_writes_total",
+    "The number of connections dropped because writing to them failed.",
+    lambda: COUNTERS.failed_writes, kind="counter",
+)
+
+#: Diffs a room's active members against the snapshot taken during the
+#: previous presence update, stores the new snapshot and bumps the
+#: room's presence version if anything changed.  Returns the version,
+#: the added and removed usernames and the member count.
+PRESENCE_UPDATE_SCRIPT = """
+local members = redis.call("ZRANGEBYSCORE", KEYS[1], ARGV[1], "+inf")
+local previous = {}
+for _, username in ipairs(redis.call("SMEMBERS", KEYS[2])) do
+  previous[username] = true
+end
+
+local current, added, removed = {}, {}, {}
+for _, username in ipairs(members) do
+  current[username] = true
+  if not previous[username] then
+    table.insert(added, username)
+  end
+end
+
+for username in pairs(previous) do
+  if not current[username] then
+    table.insert(removed, username)
+  end
+end
+
+if #added == 0 and #removed == 0 then
+  return {tonumber(redis.call("GET", KEYS[3]) or 0), added, removed, #members}
+end
+
+redis.call("DEL", KEYS[2])
+for i = 1, #members, 1000 do
+  redis.call("SADD", KEYS[2], unpack(members, i, math.min(i + 999, #members)))
+end
+
+return {redis.call("INCR", KEYS[3]), added, removed, #members}
+"""
+
+
+#: The value POST_MESSAGE_SCRIPT returns alongside the number of
+#: milliseconds to wait when a message goes over its rate limit.
+RATE_LIMITED = b"limited"
+
+#: Handles an inbound chat message in a single round trip: takes a
+#: token from each of the sender's rate limit buckets (KEYS[7] onwards
+#: along with ARGV[9] onwards), refreshes the sender's presence,
+#: appends the message to the room's history unless history is
+#: disabled and broadcasts it.  Returns the id of the broadcast event
+#: or RATE_LIMITED and a retry delay if the sender is out of tokens.
+POST_MESSAGE_SCRIPT = PUBLISH_FUNCTION + TAKE_TOKENS_FUNCTION + """
+local retry_after = take_tokens({unpack(KEYS, 7)}, {unpack(ARGV, 9)})
+if retry_after > 0 then
+  return {"limited", retry_after}
+end
+
+redis.call("ZADD", KEYS[1], ARGV[1], ARGV[2])
+redis.call("ZADD", KEYS[6], 0, ARGV[2])
+redis.call("SADD", KEYS[2], ARGV[3])
+if tonumber(ARGV[4]) > 0 then
+  redis.call("XADD", KEYS[3], "MAXLEN", "~", ARGV[4], "*", "username", ARGV[2], "message", ARGV[5])
+end
+
+return publish(KEYS[4], KEYS[5], ARGV[6], ARGV[7], ARGV[8])
+"""
+
+#: Gets up to ARGV[3] of a room's active members whose usernames sort
+#: after ARGV[2] (or from the start if it's empty), along with the
+#: total number of active members.  Members are walked through in the
+#: room's roster, a copy of its member set where every score is 0 so
+#: that heartbeats can't reorder it.  Members whose last heartbeat is
+#: older than ARGV[1] are skipped.
+MEMBERS_PAGE_SCRIPT = """
+local min_score, limit = tonumber(ARGV[1]), tonumber(ARGV[3])
+local start = ARGV[2] == "" and "-" or "(" .. ARGV[2]
+local usernames = {}
+while #usernames < limit do
+  local batch = redis.call("ZRANGEBYLEX", KEYS[2], start, "+", "LIMIT", 0, limit - #usernames)
+  if #batch == 0 then
+    break
+  end
+
+  for _, username in ipairs(batch) do
+    local score = redis.call("ZSCORE", KEYS[1], username)
+    if score and tonumber(score) >= min_score then
+      table.insert(usernames, username)
+    end
+  end
+
+  start = "(" .. batch[#batch]
+end
+
+return {usernames, redis.call("ZCOUNT", KEYS[1], min_score, "+inf")}
+"""
+
+#: Releases one of a member's connections to a room.  If it was their
+#: last one, their connection count is dropped and, given a non-zero
+#: grace period in ARGV[3], a departure marker holding the token in
+#: ARGV[2] is set.  Returns 1 if it was their last connection.  Members
+#: without a count were swept after their heartbeats expired, which
+#: already announced that they left, so releasing their connections
+#: returns 0.
+RELEASE_CONNECTION_SCRIPT = """
+if redis.call("HEXISTS", KEYS[1], ARGV[1]) == 0 then
+  return 0
+end
+
+if redis.call("HINCRBY", KEYS[1], ARGV[1], -1) > 0 then
+  return 0
+end
+
+redis.call("HDEL", KEYS[1], ARGV[1])
+if tonumber(ARGV[3]) > 0 then
+  redis.call("SET", KEYS[2], ARGV[2], "PX", ARGV[3])
+end
+
+return 1
+"""
+
+#: Deletes a departing member's marker if it still belongs to the
+#: departure that's being finished and the member hasn't reconnected
+#: since.  Returns 1 if it did.
+FINISH_DEPARTURE_SCRIPT = """
+if redis.call("HEXISTS", KEYS[2], ARGV[2]) == 1 then
+  return 0
+end
+
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+  return redis.call("DEL", KEYS[1])
+end
+
+return 0
+"""
+
+
+def EventMessage(**kwargs):
+    return WireMessage(kwargs)
+
+
+def PresenceSnapshotMessage(presence):
+    return EventMessage(type="presence_snapshot", version=presence.version, usernames=sorted(presence.members))
+
+
+def JoinMessage(event_id, room_name, username):
+    return EventMessage(type="join", id=event_id, username=username)
+
+
+def LeaveMessage(event_id, room_name, username):
+    return EventMessage(type="leave", id=event_id, username=username)
+
+
+def BroadcastMessage(event_id, room_name, username, message):
+    return EventMessage(type="broadcast", id=event_id, username=username, message=message)
+
+
+#: The messages that replayed events get sent as.  Presence events
+#: aren't replayed since resuming clients get sent the current member
+#: list instead.
+REPLAYED_MESSAGES = {
+    "join": JoinMessage,
+    "leave": LeaveMessage,
+    "broadcast": BroadcastMessage,
+}
+
+
+def room_key(room_name):
+    return f"chat:rooms:{room_name}"
+
+
+def roster_key(room_name):
+    return f"chat:roster:{room_name}"
+
+
+def departure_key(room_name, username):
+    return f"chat:rooms:{room_name}:departing:{username}"
+
+
+def connections_key(room_name):
+    return f"chat:connections:{room_name}"
+
+
+def presence_key(room_name):
+    return f"chat:presence:{room_name}"
+
+
+def presence_snapshot_key(room_name):
+    return f"chat:presence:{room_name}:members"
+
+
+def presence_version_key(room_name):
+    return f"chat:presence:{room_name}:version"
+
+
+class HeartbeatBuffer:
+    """Coalesces presence heartbeats per (room, user) and periodically
+    writes them to Redis in a single pipelined batch.
+    """
+
+    def __init__(self, redis, flush_interval):
+        self.redis = redis
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.flusher = gevent.spawn(self.flush_forever)
+
+    def touch(self, room_name, username):
+        self.pending[room_name, username] = int(time.time())
+
+    def discard(self, room_name, username):
+        self.pending.pop((room_name, username), None)
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+        scores_by_room, rosters_by_room = defaultdict(list), defaultdict(list)
+        for (room_name, username), timestamp in pending.items():
+            scores_by_room[room_name].extend((timestamp, username))
+            rosters_by_room[room_name].extend((0, username))
+
+        pipeline = self.redis.pipeline(transaction=False)
+        for room_name, scores in scores_by_room.items():
+            pipeline.zadd(room_key(room_name), *scores)
+            pipeline.zadd(roster_key(room_name), *rosters_by_room[room_name])
+
+        pipeline.sadd(ACTIVE_ROOMS_KEY, *scores_by_room)
+        pipeline.execute()
+
+    def flush_forever(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                LOGGER.exception("Failed to flush heartbeats.")
+
+
+class RoomPresence:
+    """This worker's copy of a room's member list.  It is loaded from
+    the room's snapshot when the worker starts hosting the room and
+    is kept up to date by applying presence deltas.
+    """
+
+    __slots__ = ["members", "version"]
+
+    def __init__(self, version, members):
+        self.version = version
+        self.members = members
+
+    def apply(self, version, added, removed):
+        """Apply a delta to this member list.  Returns False if the
+        delta skipped a version, meaning the list must be reloaded.
+        """
+        if version <= self.version:
+            return True
+
+        if version > self.version + 1:
+            return False
+
+        self.version = version
+        self.members.difference_update(removed)
+        self.members.update(added)
+        return True
+
+
+class Connection:
+    """The state this worker keeps for each of its sockets that's a
+    member of at least one room.
+    """
+
+    __slots__ = ["rooms", "username"]
+
+    def __init__(self, username):
+        self.username = username
+        self.rooms = set()
+
+
+class Room:
+    """A room's local members, mapped to their presence modes.
+
+    Broadcasts iterate over an immutable snapshot of the members that
+    is only rebuilt when someone joins or leaves, so they never have
+    to copy the member list or take the room's lock.  Rooms are
+    closed once their last member leaves and closed rooms never get
+    reopened.
+    """
+
+    __slots__ = ["closed", "lock", "members", "snapshot"]
+
+    def __init__(self):
+        self.closed = False
+        self.lock = Lock()
+        self.members = {}
+        self.snapshot = ()
+
+    def add(self, socket, presence_mode):
+        self.members[socket] = presence_mode
+        self.snapshot = tuple(self.members.items())
+
+    def remove(self, socket):
+        del self.members[socket]
+        self.snapshot = tuple(self.members.items())
 
 
 class ChatroomRegistry:
-    def __init__(self, redis):
+    """Keeps track of which local sockets are members of which rooms.
+    Rooms are dropped as soon as their last local socket leaves them
+    and sockets are dropped as soon as they leave their last room, so
+    memory use is proportional to current membership only.  Room names
+    and usernames are interned so that every reference to the same
+    room or member shares a single string.
+
+    Each room has its own lock so membership changes in one room never
+    wait on another.
+    """
+
+    def __init__(self, redis, events, heartbeat_flush_interval, presence_debounce, leave_grace_period):
         self.redis = redis
-        self.sockets_mutex = Lock()
-        self.sockets_by_room = defaultdict(dict)
-        self.rooms_by_socket = defaultdict(set)
+        self.events = events
+        self.presence_debounce = presence_debounce
+        self.presence_by_room = {}
+        self.update_presence = redis.register_script(PRESENCE_UPDATE_SCRIPT, "update_presence")
+        self.leave_grace_period = leave_grace_period
+        self.finish_departure_script = redis.register_script(FINISH_DEPARTURE_SCRIPT, "finish_departure")
+        self.release_connection_script = redis.register_script(RELEASE_CONNECTION_SCRIPT, "release_connection")
+        self.post_message_script = redis.register_script(POST_MESSAGE_SCRIPT, "post_message")
+        self.members_page_script = redis.register_script(MEMBERS_PAGE_SCRIPT, "members_page")
+        self.heartbeats = HeartbeatBuffer(redis, heartbeat_flush_interval)
+        self.rooms = {}
+        self.connections = {}
+        self.listeners = []
+
+    def export_metrics(self):
+        """Export this registry's gauges through the worker's metrics.
+        Only the worker's own registry should export them.
+        """
+        METRICS.callback(
+            "chat_sockets",
+            "The number of sockets that are members of at least one room on this worker.",
+            self.count_sockets,
+        )
+        METRICS.callback("chat_rooms", "The number of rooms this worker hosts sockets for.", self.count_rooms)
+        METRICS.callback(
+            "chat_registry_memory_bytes",
+            "The approximate number of bytes used to keep track of room membership on this worker.",
+            self.get_memory_usage,
+        )
+        METRICS.callback(
+            "chat_outbox_queued_messages",
+            "The number of messages waiting to be written to this worker's sockets.",
+            self.count_queued_messages,
+        )
+
+    def add_listener(self, listener):
+        """Register an object whose room_opened and room_closed
+        methods get called whenever this worker starts or stops hosting
+        sockets for a room.
+        """
+        self.listeners.append(listener)
+
+    def notify_room_opened(self, room_name):
+        for listener in self.listeners:
+            listener.room_opened(room_name)
+
+    def notify_room_closed(self, room_name):
+        self.presence_by_room.pop(room_name, None)
+        for listener in self.listeners:
+            listener.room_closed(room_name)
 
     def touch_member(self, room_name, username):
-        self.redis.zadd(f"chat:rooms:{room_name}", int(time.time()), username)
+        self.heartbeats.touch(room_name, username)
+
+    def post_message(self, room_name, username, message, history_length, buckets=([], [])):
+        """Broadcast a member's message to a room, recording it in the
+        room's history and counting it as a heartbeat.  *buckets* are
+        the rate limit buckets the message draws from, as returned by
+        RateLimiter.get_buckets().
+
+        Returns:
+          A tuple of the id of the broadcast event and the number of
+          milliseconds the member has to wait before trying again.
+          The id is None if the member went over their rate limit.
+        """
+        bucket_keys, bucket_args = buckets
+        result = self.post_message_script(
+            keys=[
+                room_key(room_name),
+                ACTIVE_ROOMS_KEY,
+                history_key(room_name),
+                sequence_key(room_name),
+                replay_key(room_name),
+                roster_key(room_name),
+                *bucket_keys,
+            ],
+            args=[
+                int(time.time()),
+                username,
+                room_name,
+                history_length,
+                message,
+                self.events.encode("broadcast", room_name, username, message),
+                room_channel(room_name),
+                self.events.replay_length,
+                *bucket_args,
+            ],
+        )
+        if isinstance(result, list) and result[0] == RATE_LIMITED:
+            return None, result[1]
+
+        # The script refreshed the member's presence itself so any
+        # buffered heartbeat would be redundant.
+        self.heartbeats.discard(room_name, username)
+        return result, 0
+
+    def add_member_to_room(self, room_name, socket, username, presence_mode=PRESENCE_FULL):
+        """Add a socket to a room.  Returns True if the rest of the room
+        already considers the member present, either because they have
+        another connection in the room or because they're rejoining it
+        within their leave grace period.
+        """
+        room_name, username = sys.intern(room_name), sys.intern(username)
+        connection = self.connections.get(socket)
+        if connection is not None and room_name in connection.rooms:
+            # Sockets that join a room they're already in only change
+            # their presence mode.  Their connection was counted the
+            # first time around and only gets released once.
+            room = self.rooms.get(room_name)
+            if room is not None:
+                with room.lock:
+                    if socket in room.members:
+                        room.add(socket, presence_mode)
+            return True
+
+        # New members are written through immediately so that they
+        # show up in the presence list that follows their join event.
+        self.heartbeats.discard(room_name, username)
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.delete(departure_key(room_name, username))
+        pipeline.hincrby(connections_key(room_name), username, 1)
+        pipeline.zadd(room_key(room_name), int(time.time()), username)
+        pipeline.zadd(roster_key(room_name), 0, username)
+        pipeline.sadd(ACTIVE_ROOMS_KEY, room_name)
+        rejoined, connection_count, _, _, _ = pipeline.execute()
+        if connection is None:
+            connection = self.connections.setdefault(socket, Connection(username))
 
-    def add_member_to_room(self, room_name, socket, username):
-        self.touch_member(room_name, username)
-        with self.sockets_mutex:
-            self.sockets_by_room[room_name][socket] = username
-            self.rooms_by_socket[socket].add(room_name)
+        while True:
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = self.rooms.setdefault(room_name, Room())
+
+            with room.lock:
+                # The room may have been closed and dropped after we
+                # looked it up, in which case a fresh one is needed.
+                if room.closed:
+                    continue
+
+                room_opened = not room.members
+                room.add(socket, presence_mode)
+                connection.rooms.add(room_name)
+                break
+
+        if room_opened:
+            self.notify_room_opened(room_name)
+            self.load_presence(room_name)
+
+        return bool(rejoined) or connection_count > 1
 
     def remove_member_from_room(self, room_name, socket):
-        username = self.sockets_by_room[room_name][socket]
-        self.redis.zrem(f"chat:rooms:{room_name}", username)
-        with self.sockets_mutex:
-            try:
-                del self.sockets_by_room[room_name][socket]
-                self.rooms_by_socket[socket].remove(room_name)
-            except KeyError:
-                pass
+        """Remove a socket from a room.  Whether the member left the
+        room is up to release_connection.
+        """
+        connection = self.connections.get(socket)
+        if connection is None or room_name not in connection.rooms:
+            raise KeyError(f"Socket is not a member of room {room_name!r}.")
+
+        connection.rooms.remove(room_name)
+        if not connection.rooms:
+            self.connections.pop(socket, None)
+
+        if self.leave_room(room_name, socket):
+            self.notify_room_closed(room_name)
 
     def remove_member_from_all_rooms(self, socket):
-        with self.sockets_mutex:
-            room_names = list(self.rooms_by_socket[socket])
-            for room_name in room_names:
-                try:
-                    del self.sockets_by_room[room_name][socket]
-                except KeyError:
-                    continue
+        connection = self.connections.pop(socket, None)
+        if connection is None:
+            return []
+
+        room_names = list(connection.rooms)
+        for room_name in room_names:
+            if self.leave_room(room_name, socket):
+                self.notify_room_closed(room_name)
+
+        return room_names
+
+    def leave_room(self, room_name, socket):
+        """Remove a socket from a room's local members.  Returns True if
+        it was the room's last local member.
+        """
+        room = self.rooms.get(room_name)
+        if room is None:
+            return False
+
+        with room.lock:
+            if socket not in room.members:
+                return False
+
+            room.remove(socket)
+            if room.members:
+                return False
+
+            room.closed = True
+            if self.rooms.get(room_name) is room:
+                del self.rooms[room_name]
+            return True
+
+    def release_connection(self, room_name, username, token="", ttl=0):
+        """Release one of a member's connections to a room, across all
+        workers.  Returns True if it was their last one.
+        """
+        return self.release_connection_script(
+            keys=[connections_key(room_name), departure_key(room_name, username)],
+            args=[username, token, ttl],
+        )
+
+    def schedule_departure(self, room_name, username):
+        """Announce that a disconnected member left a room once their
+        grace period is over, unless they rejoin it before then.  This
+        keeps clients with flaky connections from flooding the room
+        with joins, leaves and presence updates.  Members that are
+        still connected to the room some other way don't leave at all.
+        """
+        token = uuid4().hex
+        ttl = int(self.leave_grace_period * 1000) + DEPARTURE_MARGIN if self.leave_grace_period else 0
+        if not self.release_connection(room_name, username, token, ttl):
+            return
+
+        if not self.leave_grace_period:
+            self.depart(room_name, username)
+            return
+
+        gevent.spawn_later(self.leave_grace_period, self.finish_departure, room_name, username, token)
 
-            del self.rooms_by_socket[socket]
-            return room_names
+    def finish_departure(self, room_name, username, token):
+        try:
+            # Members that rejoined in the meantime will have deleted
+            # the marker and members that disconnected again will
+            # have replaced it with their latest departure's token.
+            if self.finish_departure_script(
+                    keys=[departure_key(room_name, username), connections_key(room_name)],
+                    args=[token, username],
+            ):
+                self.depart(room_name, username)
+        except Exception:
+            LOGGER.exception("Failed to finish departure of %r from room %r.", username, room_name)
+
+    def depart(self, room_name, username):
+        self.heartbeats.discard(room_name, username)
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.zrem(room_key(room_name), username)
+        pipeline.zrem(roster_key(room_name), username)
+        self.events.publish("leave", room_name, username, client=pipeline)
+        pipeline.execute()
+        self.schedule_presence_update(room_name)
 
     def get_members(self, room_name):
-        members = self.redis.zrangebyscore(f"chat:rooms:{room_name}", int(time.time() - 60), "+inf")
+        members = self.redis.zrangebyscore(room_key(room_name), int(time.time() - MEMBER_TTL), "+inf")
         return sorted(username.decode() for username in members)
 
+    def get_members_page(self, room_name, limit, after=None):
+        """Get up to *limit* of a room's active members, ordered by
+        username, along with the total number of active members.  The
+        returned cursor can be passed back in as *after* to get the
+        next page and is None once every member has been listed.
+        Heartbeats don't move members around, so pages neither skip
+        nor repeat members that stay in the room.
+        """
+        members, count = self.members_page_script(
+            keys=[room_key(room_name), roster_key(room_name)],
+            args=[int(time.time() - MEMBER_TTL), after or "", limit],
+        )
+        usernames = [username.decode() for username in members]
+        cursor = usernames[-1] if len(usernames) == limit else None
+        return usernames, count, cursor
+
+    def load_presence(self, room_name):
+        pipeline = self.redis.pipeline()
+        pipeline.get(presence_version_key(room_name))
+        pipeline.smembers(presence_snapshot_key(room_name))
+        version, members = pipeline.execute()
+        presence = RoomPresence(int(version or 0), {username.decode() for username in members})
+        self.presence_by_room[room_name] = presence
+        return presence
+
+    def get_presence(self, room_name):
+        try:
+            return self.presence_by_room[room_name]
+        except KeyError:
+            return self.load_presence(room_name)
+
+    def schedule_presence_update(self, room_name):
+        """Publish the room's member list once the current burst of
+        joins and leaves has had time to settle.  Whichever worker
+        claims the update first computes the list for the whole
+        cluster and any changes made in the meantime are folded into
+        that same update.
+        """
+        if self.redis.set(presence_key(room_name), 1, nx=True, px=PRESENCE_CLAIM_TTL):
+            gevent.spawn_later(self.presence_debounce, self.publish_presence, room_name)
+
+    def publish_presence(self, room_name):
+        try:
+            # The claim is released before the members are read so
+            # that changes made after the read schedule a new update.
+            self.redis.delete(presence_key(room_name))
+            version, added, removed, count = self.update_presence(
+                keys=[room_key(room_name), presence_snapshot_key(room_name), presence_version_key(room_name)],
+                args=[int(time.time() - MEMBER_TTL)],
+            )
+
+            added = sorted(username.decode() for username in added)
+            removed = sorted(username.decode() for username in removed)
+            self.events.publish("presence", room_name, version, added, removed, count)
+        except Exception:
+            LOGGER.exception("Failed to publish presence for room %r.", room_name)
+
+    def count_sockets(self):
+        return len(self.connections)
+
+    def count_rooms(self):
+        return len(self.rooms)
+
+    def count_queued_messages(self):
+        return sum(len(socket.queue) for socket in list(self.connections))
+
+    def get_memory_usage(self):
+        """Estimate the number of bytes taken up by this registry's
+        bookkeeping, not counting the sockets themselves.  Strings
+        shared through interning are only counted once.
+        """
+        seen = set()
+
+        def sizeof_string(string):
+            if id(string) in seen:
+                return 0
+
+            seen.add(id(string))
+            return sys.getsizeof(string)
+
+        size = sys.getsizeof(self.rooms) + sys.getsizeof(self.connections)
+        for room_name, room in list(self.rooms.items()):
+            size += sizeof_string(room_name) + sys.getsizeof(room) + sys.getsizeof(room.lock)
+            size += sys.getsizeof(room.members) + sys.getsizeof(room.snapshot)
+            size += sum(sys.getsizeof(member) for member in room.snapshot)
+
+        for connection in list(self.connections.values()):
+            size += sys.getsizeof(connection) + sys.getsizeof(connection.rooms)
+            size += sizeof_string(connection.username)
+
+        size += sys.getsizeof(self.presence_by_room)
+        for presence in list(self.presence_by_room.values()):
+            size += sys.getsizeof(presence) + sys.getsizeof(presence.members)
+            size += sum(sizeof_string(username) for username in presence.members)
+
+        return size
+
+    def get_snapshot(self, room_name):
+        """Get the (socket, presence mode) pairs of a room's local
+        members.  The returned tuple is never modified.
+        """
+        room = self.rooms.get(room_name)
+        if room is None:
+            return ()
+        return room.snapshot
+
     def get_sockets(self, room_name):
-        return list(self.sockets_by_room[room_name])
+        return [socket for socket, _ in self.get_snapshot(room_name)]
 
-    def send_to_all(self, room_name, message):
-        for socket in self.get_sockets(room_name):
+    def send_to_all(self, room_name, message, delivery=None):
+        started_at = time.perf_counter()
+        message.delivery = delivery
+        for socket, _ in self.get_snapshot(room_name):
             try:
                 socket.send(message)
+                if delivery is not None:
+                    delivery.add()
             except Exception as e:
+                # Outboxes only fail once their connection is going
+                # away, at which point the connection's handler takes
+                # care of removing it from its rooms.
                 LOGGER.warning(".send() failed on socket: %s", e)
-                self.remove_member_from_room(room_name, socket)
+                SEND_TO_ALL_FAILURES.inc()
+
+        SEND_TO_ALL_SECONDS.observe(time.perf_counter() - started_at)
+
+    def send_presence(self, room_name, message_factories, delivery=None):
+        """Send each socket in a room the presence message matching the
+        presence mode it joined with.  Each mode's message is built at
+        most once and only if some socket uses that mode.  Sockets
+        whose mode's factory returns None are skipped.
+        """
+        messages_by_mode = {}
+        for socket, presence_mode in self.get_snapshot(room_name):
+            try:
+                message = messages_by_mode[presence_mode]
+            except KeyError:
+                message = messages_by_mode[presence_mode] = message_factories[presence_mode]()
+                if message is not None:
+                    message.delivery = delivery
+
+            if message is None:
+                continue
+
+            try:
+                socket.send(message)
+                if delivery is not None:
+                    delivery.add()
+            except Exception as e:
+                LOGGER.warning(".send() failed on socket: %s", e)
+                SEND_TO_ALL_FAILURES.inc()
 
 
 class ChatroomRegistryComponent:
@@ -79,40 +856,248 @@ class ChatroomRegistryComponent:
     def can_handle_parameter(self, parameter):
         return parameter.annotation is ChatroomRegistry
 
-    def resolve(self, redis: Redis):
-        return ChatroomRegistry(redis)
+    def resolve(self, redis: Redis, events: RoomEvents, settings: Settings):
+        registry = ChatroomRegistry(
+            redis,
+            events,
+            heartbeat_flush_interval=settings.strict_get("chat.heartbeat_flush_interval"),
+            presence_debounce=settings.strict_get("chat.presence_debounce"),
+            leave_grace_period=settings.strict_get("chat.leave_grace_period"),
+        )
+        registry.export_metrics()
+        return registry
+
+
+class Delivery:
+    """Follows an event from the moment the listener receives it until
+    every local socket it was queued up for is done with it.
+    """
+
+    __slots__ = [
+        "event_id", "event_type", "listener", "pending", "publish_lag", "received_at", "room_name", "sealed", "sockets",
+        "trace",
+    ]
+
+    def __init__(self, listener, event_id, event_type, room_name, trace, publish_lag):
+        self.listener = listener
+        self.event_id = event_id
+        self.event_type = event_type
+        self.room_name = room_name
+        self.trace = trace
+        self.publish_lag = publish_lag
+        self.received_at = time.perf_counter()
+        self.pending = 0
+        self.sockets = 0
+        self.sealed = False
+
+    def add(self):
+        self.pending += 1
+        self.sockets += 1
+
+    def done(self):
+        self.pending -= 1
+        if self.sealed and not self.pending:
+            self.listener.record_delivery(self)
+
+    def seal(self):
+        """Called once the event has been queued up for every socket
+        it's going to be sent to.
+        """
+        self.sealed = True
+        if not self.pending:
+            self.listener.record_delivery(self)
+
+
+class RedisSubscriber:
+    """Subscribes a worker to room channels directly through Redis.
+    """
+
+    def __init__(self, redis):
+        self.pubsub = redis.pubsub()
+        self.pubsub_mutex = Lock()
+        self.connected = Event()
+
+    def subscribe(self, channel):
+        with self.pubsub_mutex:
+            self.pubsub.subscribe(channel)
+            self.connected.set()
+
+    def unsubscribe(self, channel):
+        with self.pubsub_mutex:
+            self.pubsub.unsubscribe(channel)
+
+    def get_message(self):
+        # The pubsub connection is opened by the first subscription.
+        # Unlike pubsub.listen(), this keeps reading even when every
+        # channel has been unsubscribed from.
+        self.connected.wait()
+        return self.pubsub.handle_message(self.pubsub.parse_response())
+
+    def get_backlog(self):
+        """Get the number of bytes waiting to be read off the pubsub
+        connection, including any that have already been buffered.
+        """
+        connection = self.pubsub.connection
+        if connection is None or connection._sock is None:
+            return 0
+
+        buffered = 0
+        buffer = getattr(connection._parser, "_buffer", None)
+        if buffer is not None:
+            buffered = buffer.length - buffer.bytes_read
+
+        return buffered + unread_bytes(connection._sock)
 
 
 class ChatroomListener:
-    def __init__(self, redis, registry):
-        self.redis = redis
+    """Relays events published to the rooms this worker hosts sockets
+    for.  Each room has its own channel and the listener only stays
+    subscribed to a room's channel for as long as the registry has
+    local sockets in that room.  Channels are subscribed to through
+    either a RedisSubscriber or, when the host runs a relay, a
+    RelaySubscriber.
+
+    Events that take longer than *slow_event_threshold* seconds to go
+    from being published to being written to every local socket get
+    logged along with their trace.
+    """
+
+    def __init__(self, subscriber, registry, slow_event_threshold=0):
+        self.subscriber = subscriber
         self.registry = registry
+        self.slow_event_threshold = slow_event_threshold
+        self.registry.add_listener(self)
+        self.pending_subscriptions = {}
+        self.down_since = None
         self.listener = gevent.spawn(self.listen)
 
+    def export_metrics(self):
+        """Export this listener's backlog through the worker's metrics.
+        Only the worker's own listener should export it.
+        """
+        METRICS.callback(
+            "chat_listener_backlog_bytes",
+            "The number of bytes of events this worker has been sent but has yet to handle.",
+            self.subscriber.get_backlog,
+        )
+
+    def room_opened(self, room_name):
+        channel = room_channel(room_name)
+        if self.down_since is not None:
+            # Nothing can be acknowledged until the subscriber comes
+            # back, at which point the subscription is made anyway.
+            self.subscriber.subscribe(channel)
+            return
+
+        subscribed = self.pending_subscriptions[channel] = Event()
+        self.subscriber.subscribe(channel)
+
+        # Wait for the subscription to be acknowledged so that any
+        # events the caller publishes next are guaranteed to reach us.
+        if not subscribed.wait(timeout=SUBSCRIBE_TIMEOUT):
+            self.pending_subscriptions.pop(channel, None)
+            LOGGER.warning("Timed out while subscribing to %r.", channel)
+
+    def room_closed(self, room_name):
+        self.subscriber.unsubscribe(room_channel(room_name))
+
     def listen(self):
-        pubsub = self.redis.pubsub()
-        pubsub.subscribe("chat:events")
-        for message in pubsub.listen():
+        retry_delay = RETRY_DELAY_MIN
+        while True:
+            try:
+                message = self.subscriber.get_message()
+            except Exception:
+                # Only the start of an outage is logged so that a
+                # subscriber that stays down doesn't flood the logs.
+                if self.down_since is None:
+                    LOGGER.exception("Failed to read from subscriber.")
+                    self.down_since = time.monotonic()
+
+                gevent.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, RETRY_DELAY_MAX)
+                continue
+
+            if self.down_since is not None:
+                LOGGER.info("Subscriber recovered after %.1f seconds.", time.monotonic() - self.down_since)
+                self.down_since = None
+                retry_delay = RETRY_DELAY_MIN
+
+            if message is None:
+                continue
+
+            if message["type"] == "subscribe":
+                subscribed = self.pending_subscriptions.pop(message["channel"].decode(), None)
+                if subscribed is not None:
+                    subscribed.set()
+
             if message["type"] != "message":
                 continue
 
+            event = None
             try:
                 event = json.loads(message["data"])
                 handler = getattr(self, f"handle_{event['type']}")
-                handler(*event["args"])
+                delivery = self.track(event)
+                handler(event["id"], *event["args"], delivery=delivery)
+                delivery.seal()
             except Exception:
                 LOGGER.exception("Failed to handle event: %r", event)
 
-    def handle_join(self, room_name, username):
-        self.registry.send_to_all(room_name, JsonMessage(type="join", username=username))
-        self.registry.send_to_all(room_name, JsonMessage(type="presence", usernames=self.registry.get_members(room_name)))
+    def track(self, event):
+        trace = event.get("trace") or {}
+        publish_lag = None
+        if trace.get("published_at"):
+            publish_lag = time.time() - trace["published_at"]
+            PUBLISH_LAG_SECONDS.labels(event["type"]).observe(max(0, publish_lag))
+
+        return Delivery(self, event["id"], event["type"], event["args"][0], trace, publish_lag)
+
+    def record_delivery(self, delivery):
+        delivery_lag = time.perf_counter() - delivery.received_at
+        DELIVERY_SECONDS.labels(delivery.event_type).observe(delivery_lag)
+        total_lag = (delivery.publish_lag or 0) + delivery_lag
+        if self.slow_event_threshold and total_lag >= self.slow_event_threshold:
+            LOGGER.warning(
+                "Slow %r event %d in room %r: publish lag %s, delivery lag %.3fs across %d sockets "
+                "(origin: %s, request id: %s).",
+                delivery.event_type, delivery.event_id, delivery.room_name,
+                "unknown" if delivery.publish_lag is None else f"{delivery.publish_lag:.3f}s",
+                delivery_lag, delivery.sockets, delivery.trace.get("origin"), delivery.trace.get("request_id"),
+            )
+
+    def handle_join(self, event_id, room_name, username, delivery=None):
+        self.registry.send_to_all(room_name, JoinMessage(event_id, room_name, username), delivery)
+
+    def handle_leave(self, event_id, room_name, username, delivery=None):
+        self.registry.send_to_all(room_name, LeaveMessage(event_id, room_name, username), delivery)
+
+    def handle_presence(self, event_id, room_name, version, added, removed, count, delivery=None):
+        presence = self.registry.presence_by_room.get(room_name)
+        if presence is None:
+            return
+
+        if presence.apply(version, added, removed):
+            def make_delta_message():
+                if version == presence.version and (added or removed):
+                    return EventMessage(
+                        type="presence_delta", id=event_id, version=version, added=added, removed=removed,
+                    )
+
+        else:
+            # We missed an update so delta clients get a fresh snapshot.
+            presence = self.registry.load_presence(room_name)
 
-    def handle_leave(self, room_name, username):
-        self.registry.send_to_all(room_name, JsonMessage(type="leave", username=username))
-        self.registry.send_to_all(room_name, JsonMessage(type="presence", usernames=self.registry.get_members(room_name)))
+            def make_delta_message():
+                return PresenceSnapshotMessage(presence)
 
-    def handle_broadcast(self, room_name, username, message):
-        self.registry.send_to_all(room_name, JsonMessage(type="broadcast", username=username, message=message))
+        self.registry.send_presence(room_name, {
+            PRESENCE_FULL: lambda: EventMessage(type="presence", id=event_id, usernames=sorted(presence.members)),
+            PRESENCE_DELTA: make_delta_message,
+            PRESENCE_COUNT: lambda: EventMessage(type="presence_count", id=event_id, count=count),
+        }, delivery)
+
+    def handle_broadcast(self, event_id, room_name, username, message, delivery=None):
+        self.registry.send_to_all(room_name, BroadcastMessage(event_id, room_name, username, message), delivery)
 
 
 class ChatroomListenerComponent:
@@ -122,64 +1107,207 @@ class ChatroomListenerComponent:
     def can_handle_parameter(self, parameter):
         return parameter.annotation is ChatroomListener
 
-    def resolve(self, redis: Redis, registry: ChatroomRegistry):
-        return ChatroomListener(redis, registry)
+    def resolve(self, redis: Redis, registry: ChatroomRegistry, settings: Settings):
+        relay_socket_path = settings.strict_get("relay.socket_path")
+        if relay_socket_path:
+            subscriber = RelaySubscriber(relay_socket_path)
+        else:
+            subscriber = RedisSubscriber(redis)
+
+        listener = ChatroomListener(subscriber, registry, settings.strict_get("chat.slow_event_threshold"))
+        listener.export_metrics()
+        return listener
+
+
+def HistoryMessage(room_name, messages, cursor):
+    return EventMessage(type="history", room_name=room_name, messages=messages, cursor=cursor)
 
 
 class ChatHandlerFactory:
-    def __init__(self, redis, registry, socket, username):
+    def __init__(
+            self,
+            redis,
+            registry,
+            events,
+            history,
+            rate_limiter,
+            outbox_factory,
+            timers,
+            batch_window,
+            socket,
+            username,
+            batched=False,
+    ):
         self.redis = redis
         self.registry = registry
+        self.events = events
+        self.history = history
+        self.rate_limiter = rate_limiter
         self.socket = socket
+        self.outbox = outbox_factory(socket, batch_window=batch_window if batched else 0)
+        self.timers = timers
+        self.peer = timers.watch(self.outbox)
         self.username = username
 
     def handle_until_close(self):
         try:
             while not self.socket.closed:
                 try:
-                    message = self.socket.receive(timeout=1)
-                except Timeout:
-                    continue
+                    message = self.socket.receive()
+                except (OSError, WebsocketError):
+                    # The outbox tears down the connection to clients
+                    # that fall too far behind and the timer wheel
+                    # does the same for clients that stop responding.
+                    if self.outbox.closed:
+                        return
+                    raise
 
-                if isinstance(message, CloseMessage):
+                if message is None or isinstance(message, CloseMessage):
                     return
 
-                event = json.loads(message.get_text())
+                event = self.socket.decode(message)
+                histogram, started_at = None, time.perf_counter()
                 try:
-                    action = getattr(self, f"on_{event.pop('type')}")
+                    event_type = event.pop("type")
+                    action = getattr(self, f"on_{event_type}")
+                    histogram = EVENT_HANDLING_SECONDS.labels(event_type)
+                    if event_type not in SELF_LIMITED_EVENT_TYPES:
+                        retry_after = self.rate_limiter.check(event_type, self.username, event.get("room_name"))
+                        if retry_after:
+                            self.reject(event_type, event.get("room_name"), retry_after)
+                            continue
+
                     action(**event)
                 except Exception:
                     LOGGER.exception("Failed to handle event: %r", event)
                     continue
+                finally:
+                    if histogram is not None:
+                        histogram.observe(time.perf_counter() - started_at)
         finally:
             self.on_close()
 
-    def dispatch_event(self, type, *args):
-        self.redis.publish("chat:events", json.dumps({
-            "type": type,
-            "args": args,
-        }))
+    def dispatch_event(self, type, room_name, *args):
+        self.events.publish(type, room_name, *args)
+
+    def reject(self, event_type, room_name, retry_after):
+        self.outbox.send(EventMessage(
+            type="rate_limited",
+            event=event_type,
+            room_name=room_name,
+            retry_after=retry_after,
+        ))
 
     def on_close(self):
-        room_names = self.registry.remove_member_from_all_rooms(self.socket)
+        self.timers.unwatch(self.peer)
+        self.outbox.close()
+        room_names = self.registry.remove_member_from_all_rooms(self.outbox)
         for room_name in room_names:
-            self.dispatch_event("leave", room_name, self.username)
+            self.registry.schedule_departure(room_name, self.username)
+
+    def on_join(self, room_name, presence=PRESENCE_FULL, resume_from=None):
+        if presence not in PRESENCE_MODES:
+            raise ValueError(f"Invalid presence mode {presence!r}.")
+
+        if resume_from is None:
+            rejoined = self.registry.add_member_to_room(room_name, self.outbox, self.username, presence)
+
+        else:
+            # Live events may start arriving as soon as we're added to
+            # the room so the outbox is held until any replayed events
+            # have been queued up in front of them.  Clients skip the
+            # events they get twice based on their ids.
+            self.outbox.pause()
+            try:
+                rejoined = self.registry.add_member_to_room(room_name, self.outbox, self.username, presence)
+                if self.resume(room_name, presence, resume_from, rejoined):
+                    return
+            finally:
+                self.outbox.resume()
+
+        if presence == PRESENCE_FULL:
+            # Fresh members get the member list along with everyone
+            # else once their join settles, but members that never
+            # left don't cause a presence update so they're sent the
+            # current list directly.
+            if rejoined:
+                members = self.registry.get_presence(room_name).members
+                self.outbox.send(EventMessage(type="presence", usernames=sorted(members)))
+
+        elif presence == PRESENCE_DELTA:
+            self.outbox.send(PresenceSnapshotMessage(self.registry.get_presence(room_name)))
+
+        else:
+            count = len(self.registry.get_presence(room_name).members)
+            self.outbox.send(EventMessage(type="presence_count", count=count))
 
-    def on_join(self, room_name):
-        self.registry.add_member_to_room(room_name, self.socket, self.username)
-        self.dispatch_event("join", room_name, self.username)
+        messages, cursor = self.history.get_page(room_name)
+        if messages:
+            self.outbox.send(HistoryMessage(room_name, messages, cursor))
+
+        # Members that come back within their grace period never
+        # left as far as everyone else is concerned.
+        if not rejoined:
+            self.dispatch_event("join", room_name, self.username)
+            self.registry.schedule_presence_update(room_name)
+
+    def resume(self, room_name, presence, resume_from, rejoined):
+        """Catch a client that reconnected up on the events it missed
+        rather than sending it a fresh history.  Returns False if the
+        client was gone for too long, in which case it has to go
+        through a fresh join.
+        """
+        events, last_id = self.events.replay(room_name, resume_from)
+        if events is None:
+            self.outbox.send_first([EventMessage(type="resume", ok=False, last_event_id=last_id)])
+            return False
+
+        messages = [EventMessage(type="resume", ok=True, last_event_id=last_id)]
+        for event in events:
+            try:
+                messages.append(REPLAYED_MESSAGES[event["type"]](event["id"], *event["args"]))
+            except KeyError:
+                continue
+
+        presence_state = self.registry.get_presence(room_name)
+        if presence == PRESENCE_FULL:
+            messages.append(EventMessage(type="presence", usernames=sorted(presence_state.members)))
+
+        elif presence == PRESENCE_DELTA:
+            messages.append(PresenceSnapshotMessage(presence_state))
+
+        else:
+            messages.append(EventMessage(type="presence_count", count=len(presence_state.members)))
+
+        self.outbox.send_first(messages)
+
+        # Clients that resume after their leave was announced have to
+        # be announced again, same as on a fresh join.
+        if not rejoined:
+            self.dispatch_event("join", room_name, self.username)
+            self.registry.schedule_presence_update(room_name)
+        return True
 
     def on_leave(self, room_name):
-        self.registry.remove_member_from_room(room_name, self.socket)
-        self.dispatch_event("leave", room_name, self.username)
+        self.registry.remove_member_from_room(room_name, self.outbox)
+        if self.registry.release_connection(room_name, self.username):
+            self.registry.depart(room_name, self.username)
 
     def on_ping(self, room_name):
         self.registry.touch_member(room_name, self.username)
-        self.socket.send(JsonMessage(type="pong"))
+        self.outbox.send(EventMessage(type="pong"))
 
     def on_message(self, room_name, message):
-        self.registry.touch_member(room_name, self.username)
-        self.dispatch_event("broadcast", room_name, self.username, message)
+        buckets = self.rate_limiter.get_buckets("message", self.username, room_name)
+        _, retry_after = self.registry.post_message(
+            room_name, self.username, message, self.history.max_length, buckets,
+        )
+        if retry_after:
+            self.reject("message", room_name, retry_after)
+
+    def on_history(self, room_name, before):
+        messages, cursor = self.history.get_page(room_name, before)
+        self.outbox.send(HistoryMessage(room_name, messages, cursor))
 
 
 class ChatHandlerFactoryComponent:
@@ -189,5 +1317,30 @@ class ChatHandlerFactoryComponent:
     def can_handle_parameter(self, parameter):
         return parameter.annotation is ChatHandlerFactory
 
-    def resolve(self, redis: Redis, registry: ChatroomRegistry):
-        return partial(ChatHandlerFactory, redis, registry)
+    def resolve(
+            self,
+            redis: Redis,
+            registry: ChatroomRegistry,
+            events: RoomEvents,
+            history: RoomHistory,
+            rate_limiter: RateLimiter,
+            settings: Settings,
+    ):
+        overflow_policy = settings.strict_get("chat.outbox_overflow_policy")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise RuntimeError(f"Invalid outbox overflow policy {overflow_policy!r}.")
+
+        outbox_factory = partial(
+            Outbox,
+            max_size=settings.strict_get("chat.outbox_size"),
+            overflow_policy=overflow_policy,
+        )
+        timers = TimerWheel(
+            tick=settings.strict_get("chat.timer_tick"),
+            ping_interval=settings.strict_get("chat.ping_interval"),
+            idle_timeout=settings.strict_get("chat.idle_timeout"),
+        )
+        batch_window = settings.strict_get("chat.batch_window")
+        return partial(
+            ChatHandlerFactory, redis, registry, events, history, rate_limiter, outbox_factory, timers, batch_window,
+        )
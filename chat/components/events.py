@@ -0,0 +1,110 @@
+import json
+import os
+import time
+from socket import gethostname
+
+from molten import Settings
+from molten.contrib.request_id import get_request_id
+
+from .redis import Redis
+
+#: Assigns the next id in a room's event sequence to an event, appends
+#: it to the room's replay buffer and publishes it to the room's
+#: channel.  The id is spliced into the already-encoded event so the
+#: script never has to decode or re-encode the payload.  Scripts that
+#: publish events as part of a larger operation embed this function.
+PUBLISH_FUNCTION = """
+local function publish(sequence_key, replay_key, payload, channel, replay_length)
+  local id = redis.call("INCR", sequence_key)
+  payload = '{"id": ' .. id .. ', ' .. string.sub(payload, 2)
+  redis.call("XADD", replay_key, "MAXLEN", "~", replay_length, "0-" .. id, "event", payload)
+  redis.call("PUBLISH", channel, payload)
+  return id
+end
+"""
+
+PUBLISH_SCRIPT = PUBLISH_FUNCTION + """
+return publish(KEYS[1], KEYS[2], ARGV[1], ARGV[2], ARGV[3])
+"""
+
+
+def get_origin():
+    """Get a string that identifies this worker process.
+    """
+    return f"{gethostname()}:{os.getpid()}"
+
+
+def room_channel(room_name):
+    return f"chat:events:{room_name}"
+
+
+def replay_key(room_name):
+    return f"chat:replay:{room_name}"
+
+
+def sequence_key(room_name):
+    return f"chat:replay:{room_name}:sequence"
+
+
+class RoomEvents:
+    """Publishes room events stamped with per-room, monotonically
+    increasing ids.  The last *replay_length* or so events of every
+    room are kept around so that reconnecting clients can catch up on
+    the events they missed.
+
+    Events carry a trace recording when and by which worker they were
+    published, along with the id of the request that caused them, if
+    any, so that slow deliveries can be tracked down.
+    """
+
+    def __init__(self, redis, replay_length):
+        self.redis = redis
+        self.replay_length = replay_length
+        self.publish_script = redis.register_script(PUBLISH_SCRIPT, "publish")
+        self.origin = get_origin()
+
+    def encode(self, type, room_name, *args):
+        return json.dumps({
+            "type": type,
+            "args": [room_name, *args],
+            "trace": {"published_at": time.time(), "origin": self.origin, "request_id": get_request_id()},
+        })
+
+    def publish(self, type, room_name, *args, client=None):
+        return self.publish_script(
+            keys=[sequence_key(room_name), replay_key(room_name)],
+            args=[self.encode(type, room_name, *args), room_channel(room_name), self.replay_length],
+            client=client,
+        )
+
+    def replay(self, room_name, after_id):
+        """Get every event published to a room after the one with the
+        given id, oldest first, along with the id of the room's latest
+        event.  The events are None if some of them are no longer
+        buffered or if the id is unknown, in which case the client has
+        to start over.
+        """
+        pipeline = self.redis.pipeline()
+        pipeline.get(sequence_key(room_name))
+        pipeline.execute_command("XRANGE", replay_key(room_name), f"0-{after_id + 1}", "+")
+        last_id, entries = pipeline.execute()
+        last_id = int(last_id or 0)
+        if after_id > last_id:
+            return None, last_id
+
+        events = [json.loads(fields[1]) for _, fields in entries]
+        if last_id > after_id and (not events or events[0]["id"] != after_id + 1):
+            return None, last_id
+
+        return events, last_id
+
+
+class RoomEventsComponent:
+    is_cacheable = True
+    is_singleton = True
+
+    def can_handle_parameter(self, parameter):
+        return parameter.annotation is RoomEvents
+
+    def resolve(self, redis: Redis, settings: Settings):
+        return RoomEvents(redis, settings.strict_get("chat.replay_length"))
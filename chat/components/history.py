@@ -0,0 +1,64 @@
+from molten import Settings
+
+from .redis import Redis
+
+
+def history_key(room_name):
+    return f"chat:history:{room_name}"
+
+
+def parse_entry(entry):
+    entry_id, fields = entry
+    fields = dict(zip(fields[::2], fields[1::2]))
+    return {
+        "id": entry_id.decode(),
+        "username": fields[b"username"].decode(),
+        "message": fields[b"message"].decode(),
+    }
+
+
+class RoomHistory:
+    """Keeps the most recent broadcasts of every room in a Redis
+    Stream capped at roughly *max_length* entries.
+    """
+
+    def __init__(self, redis, max_length, page_size):
+        self.redis = redis
+        self.max_length = max_length
+        self.page_size = page_size
+
+    def get_page(self, room_name, before=None):
+        """Get up to page_size messages sent to a room before the
+        message with the given id, oldest first.  The returned cursor
+        can be passed back in as *before* to get the previous page and
+        is None once the start of the history has been reached.
+        """
+        if before is None:
+            entries = self.redis.execute_command("XREVRANGE", history_key(room_name), "+", "-", "COUNT", self.page_size)
+
+        else:
+            # Stream ranges are inclusive so one extra entry is fetched
+            # to make up for the cursor entry itself.
+            entries = self.redis.execute_command(
+                "XREVRANGE", history_key(room_name), before, "-", "COUNT", self.page_size + 1,
+            )
+            entries = [entry for entry in entries if entry[0].decode() != before][:self.page_size]
+
+        messages = [parse_entry(entry) for entry in reversed(entries)]
+        cursor = messages[0]["id"] if len(messages) == self.page_size else None
+        return messages, cursor
+
+
+class RoomHistoryComponent:
+    is_cacheable = True
+    is_singleton = True
+
+    def can_handle_parameter(self, parameter):
+        return parameter.annotation is RoomHistory
+
+    def resolve(self, redis: Redis, settings: Settings):
+        return RoomHistory(
+            redis,
+            max_length=settings.strict_get("chat.history_length"),
+            page_size=settings.strict_get("chat.history_page_size"),
+        )
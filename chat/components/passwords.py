@@ -1,18 +1,117 @@
-from molten import Settings
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from threading import BoundedSemaphore, Lock
+
+from gevent.threadpool import ThreadPoolExecutor
+from molten import HTTP_503, HTTPError, Settings
 from passlib.context import CryptContext
 
+LOGGER = logging.getLogger(__name__)
+
+#: Hash passwords on a pool of native threads.  Hashing holds the GIL
+#: (sha256_crypt runs on the os_crypt backend), so this still stalls
+#: the hub for as long as a hash takes.  Only useful for debugging.
+THREAD_EXECUTOR = "thread"
+
+#: Hash passwords on a pool of subprocesses.  Keeps hashing off of the
+#: worker's GIL entirely.  This is the default.
+PROCESS_EXECUTOR = "process"
+
+#: The set of supported hashing executors.
+EXECUTORS = {THREAD_EXECUTOR, PROCESS_EXECUTOR}
+
+#: The crypt context used by hashing subprocesses.
+_context = None
+
+
+def _init_context(options):
+    global _context
+    _context = CryptContext(**options)
+
+
+def _hash(password):
+    return _context.hash(password)
+
+
+def _verify(password, password_hash):
+    return _context.verify(password, password_hash)
+
+
+class PasswordHasherBusy(HTTPError):
+    """Raised when too many passwords are already waiting to be hashed.
+    """
+
+    def __init__(self):
+        super().__init__(HTTP_503, {"errors": "too many requests, try again later"}, {"retry-after": "1"})
+
 
 class PasswordHasher:
-    __slots__ = ["context"]
+    """Hashes and verifies passwords on a pool of threads or processes
+    so that the CPU-bound work doesn't block the worker's greenlets.
+    At most *max_pending* operations may be queued up or running at
+    once, past which callers get a PasswordHasherBusy error.
+
+    A process pool is replaced whenever it breaks, which happens as
+    soon as any of its subprocesses dies.
+    """
+
+    __slots__ = [
+        "context", "executor", "executor_mutex", "hash_password", "make_executor", "slots", "verify_password",
+    ]
 
     def __init__(self, settings):
-        self.context = CryptContext(**settings.deep_get("passwords", default={}))
+        options = settings.deep_get("passwords", default={})
+        self.context = CryptContext(**options)
+
+        executor = settings.strict_get("hashing.executor")
+        workers = settings.strict_get("hashing.workers")
+        if executor == THREAD_EXECUTOR:
+            self.make_executor = partial(ThreadPoolExecutor, workers)
+            self.hash_password = self.context.hash
+            self.verify_password = self.context.verify
+
+        elif executor == PROCESS_EXECUTOR:
+            self.make_executor = partial(ProcessPoolExecutor, workers, initializer=_init_context, initargs=(options,))
+            self.hash_password = _hash
+            self.verify_password = _verify
+
+        else:
+            raise RuntimeError(f"Invalid hashing executor {executor!r}.")
+
+        self.executor = self.make_executor()
+        self.executor_mutex = Lock()
+        self.slots = BoundedSemaphore(settings.strict_get("hashing.max_pending"))
+
+    def run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        try:
+            executor = self.executor
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                LOGGER.warning("Hashing process pool broke.  Replacing it.")
+                self.replace_executor(executor)
+                return self.executor.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def replace_executor(self, broken_executor):
+        with self.executor_mutex:
+            # Every operation that was running on the pool fails when it
+            # breaks, but only the first one to get here replaces it.
+            if self.executor is broken_executor:
+                self.executor = self.make_executor()
+                broken_executor.shutdown(wait=False)
 
     def check(self, password_hash, password):
-        return self.context.verify(password, password_hash)
+        return self.run(self.verify_password, password, password_hash)
 
     def hash(self, password):
-        return self.context.encrypt(password)
+        return self.run(self.hash_password, password)
 
 
 class PasswordHasherComponent:
@@ -0,0 +1,105 @@
+from molten import Settings
+
+from .redis import Redis
+
+#: Takes a token from each of the given buckets, refilling them based
+#: on the time since they were last touched.  Either every bucket has
+#: a token to spare or none of them are touched, in which case the
+#: number of milliseconds until they all do is returned.  Bucket keys
+#: are paired up with their rates and bursts in *args*.  Scripts that
+#: rate limit their own work include this ahead of their body.
+TAKE_TOKENS_FUNCTION = """
+local function take_tokens(keys, args)
+  local time = redis.call("TIME")
+  local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+  local available, retry_after = {}, 0
+  for i, key in ipairs(keys) do
+    local rate, burst = tonumber(args[i * 2 - 1]), tonumber(args[i * 2])
+    local bucket = redis.call("HMGET", key, "tokens", "ts")
+    local tokens = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    available[i] = math.min(burst, tokens + elapsed * rate / 1000)
+    if available[i] < 1 then
+      retry_after = math.max(retry_after, math.ceil((1 - available[i]) * 1000 / rate))
+    end
+  end
+
+  if retry_after > 0 then
+    return retry_after
+  end
+
+  for i, key in ipairs(keys) do
+    local rate, burst = tonumber(args[i * 2 - 1]), tonumber(args[i * 2])
+    redis.call("HSET", key, "tokens", tostring(available[i] - 1), "ts", now)
+    redis.call("PEXPIRE", key, math.ceil(burst * 1000 / rate))
+  end
+
+  return 0
+end
+"""
+
+TAKE_TOKENS_SCRIPT = TAKE_TOKENS_FUNCTION + """
+return take_tokens(KEYS, ARGV)
+"""
+
+
+def user_bucket_key(event_type, username):
+    return f"chat:ratelimits:{event_type}:users:{username}"
+
+
+def room_bucket_key(event_type, room_name):
+    return f"chat:ratelimits:{event_type}:rooms:{room_name}"
+
+
+class RateLimiter:
+    """Enforces per-user and per-room token buckets on inbound events.
+
+    *limits* maps event types to their "user_rate" and "user_burst"
+    and, optionally, "room_rate" and "room_burst".  Rates are in
+    events per second.  Event types without limits are never
+    throttled.
+    """
+
+    def __init__(self, redis, limits):
+        self.redis = redis
+        self.limits = limits
+        self.take_tokens = redis.register_script(TAKE_TOKENS_SCRIPT, "take_tokens")
+
+    def get_buckets(self, event_type, username, room_name):
+        """Get the keys of the buckets an event draws from along with
+        their rates and bursts, in the shape take_tokens() expects.
+        """
+        try:
+            limits = self.limits[event_type]
+        except KeyError:
+            return [], []
+
+        keys = [user_bucket_key(event_type, username)]
+        args = [limits["user_rate"], limits["user_burst"]]
+        if "room_rate" in limits and room_name is not None:
+            keys.append(room_bucket_key(event_type, room_name))
+            args.extend([limits["room_rate"], limits["room_burst"]])
+
+        return keys, args
+
+    def check(self, event_type, username, room_name):
+        """Take a token for an event.  Returns 0 if the event may go
+        through or the number of milliseconds the client should wait
+        before trying again.
+        """
+        keys, args = self.get_buckets(event_type, username, room_name)
+        if not keys:
+            return 0
+
+        return self.take_tokens(keys=keys, args=args)
+
+
+class RateLimiterComponent:
+    is_cacheable = True
+    is_singleton = True
+
+    def can_handle_parameter(self, parameter):
+        return parameter.annotation is RateLimiter
+
+    def resolve(self, redis: Redis, settings: Settings):
+        return RateLimiter(redis, settings.strict_get("chat.rate_limits"))
@@ -1,5 +1,68 @@
+import time
+
 from molten import Settings
-from redis import StrictRedis as Redis
+from redis import StrictRedis
+from redis.client import StrictPipeline
+
+from ..metrics import METRICS
+
+#: The commands this app issues.  Their histograms are allocated up
+#: front and any others are allocated the first time they're seen.
+#: Named scripts get theirs allocated when they're registered.
+COMMANDS = (
+    "DEL", "EVALSHA", "GET", "PIPELINE", "SCRIPT EXISTS", "SCRIPT LOAD", "SET", "SSCAN", "XREVRANGE", "ZRANGEBYSCORE",
+    "ZREM",
+)
+
+#: How long Redis commands take, by command.
+REDIS_COMMAND_SECONDS = METRICS.histogram(
+    "chat_redis_command_seconds",
+    "The time it takes Redis commands to complete.  Pipelines are timed as a whole and "
+    "calls to named scripts are labeled with their name.",
+    label="command", values=COMMANDS,
+)
+
+
+class Redis(StrictRedis):
+    """A Redis client that records how long each of its commands takes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.script_labels = {}
+
+    def register_script(self, script, name=None):
+        """Register a Lua script.  Calls to scripts that are given a
+        *name* are timed separately from other scripts.
+        """
+        script = super().register_script(script)
+        if name is not None:
+            label = self.script_labels[script.sha] = f"EVALSHA {name}"
+            REDIS_COMMAND_SECONDS.labels(label)
+        return script
+
+    def execute_command(self, *args, **options):
+        started_at = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            label = args[0]
+            if label == "EVALSHA":
+                label = self.script_labels.get(args[1], label)
+
+            REDIS_COMMAND_SECONDS.labels(label).observe(time.perf_counter() - started_at)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class Pipeline(StrictPipeline):
+    def execute(self, raise_on_error=True):
+        started_at = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            REDIS_COMMAND_SECONDS.labels("PIPELINE").observe(time.perf_counter() - started_at)
 
 
 class RedisComponent:
@@ -0,0 +1,111 @@
+import logging
+import time
+from uuid import uuid4
+
+import gevent
+from molten import Settings
+
+from .chatrooms import ACTIVE_ROOMS_KEY, MEMBER_TTL, ChatroomRegistry, connections_key, room_key, roster_key
+from .events import RoomEvents
+from .redis import Redis
+
+LOGGER = logging.getLogger(__name__)
+
+#: The key holding the id of the worker that's currently allowed to sweep.
+LEADER_KEY = "chat:sweeper:leader"
+
+#: Acquires or renews the sweeper lease on behalf of a worker.
+ACQUIRE_LEASE_SCRIPT = """
+if redis.call("SET", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+  return 1
+end
+
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+  redis.call("PEXPIRE", KEYS[1], ARGV[2])
+  return 1
+end
+
+return 0
+"""
+
+#: Removes a room's expired members from it and its roster, along with
+#: any connection counts left behind by workers that died, and returns
+#: their usernames.  Rooms left without any members are dropped from
+#: the active set.
+SWEEP_ROOM_SCRIPT = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+if #expired > 0 then
+  redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+  for _, username in ipairs(expired) do
+    redis.call("HDEL", KEYS[3], username)
+    redis.call("ZREM", KEYS[4], username)
+  end
+end
+
+if redis.call("EXISTS", KEYS[1]) == 0 then
+  redis.call("SREM", KEYS[2], ARGV[2])
+end
+
+return expired
+"""
+
+
+class PresenceSweeper:
+    """Periodically removes members whose heartbeats have expired from
+    every active room and announces that they left.  Every worker runs
+    a sweeper, but only the one holding the leader lease sweeps.
+    """
+
+    def __init__(self, redis, registry, events, interval):
+        self.redis = redis
+        self.registry = registry
+        self.events = events
+        self.interval = interval
+        self.worker_id = uuid4().hex
+        self.acquire_lease = redis.register_script(ACQUIRE_LEASE_SCRIPT, "acquire_lease")
+        self.sweep_room = redis.register_script(SWEEP_ROOM_SCRIPT, "sweep_room")
+        self.sweeper = gevent.spawn(self.sweep_forever)
+
+    def is_leader(self):
+        # The lease outlives a couple of missed renewals so that
+        # leadership doesn't flap when a sweep runs long.
+        lease_ttl = int(self.interval * 3000)
+        return bool(self.acquire_lease(keys=[LEADER_KEY], args=[self.worker_id, lease_ttl]))
+
+    def sweep(self):
+        cutoff = int(time.time() - MEMBER_TTL)
+        for room_name in self.redis.sscan_iter(ACTIVE_ROOMS_KEY):
+            room_name = room_name.decode()
+            expired = self.sweep_room(
+                keys=[room_key(room_name), ACTIVE_ROOMS_KEY, connections_key(room_name), roster_key(room_name)],
+                args=[f"({cutoff}", room_name],
+            )
+            if not expired:
+                continue
+
+            pipeline = self.redis.pipeline(transaction=False)
+            for username in expired:
+                self.events.publish("leave", room_name, username.decode(), client=pipeline)
+
+            pipeline.execute()
+            self.registry.schedule_presence_update(room_name)
+
+    def sweep_forever(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                if self.is_leader():
+                    self.sweep()
+            except Exception:
+                LOGGER.exception("Failed to sweep rooms.")
+
+
+class PresenceSweeperComponent:
+    is_cacheable = True
+    is_singleton = True
+
+    def can_handle_parameter(self, parameter):
+        return parameter.annotation is PresenceSweeper
+
+    def resolve(self, redis: Redis, registry: ChatroomRegistry, events: RoomEvents, settings: Settings):
+        return PresenceSweeper(redis, registry, events, settings.strict_get("chat.sweep_interval"))
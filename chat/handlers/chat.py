@@ -1,29 +1,66 @@
 import logging
-from typing import Optional
+from typing import List, Optional
 
-from molten import HTTP_403, HTTPError, Route, annotate
-from molten.contrib.sqlalchemy import Session
-from molten.contrib.websockets import Websocket
+from molten import HTTP_400, HTTP_403, HTTPError, QueryParam, Route, annotate, schema
 
-from ..components.accounts import Account
-from ..components.chatrooms import ChatHandlerFactory
+from ..components.accounts import Account, Identity
+from ..components.chatrooms import ChatHandlerFactory, ChatroomRegistry
+from ..websockets import ChatWebsocket
 
 LOGGER = logging.getLogger(__name__)
 
+#: The maximum number of members that can be requested per page.
+MAX_MEMBERS_PER_PAGE = 100
+
+
+@schema
+class MembersPage:
+    usernames: List[str]
+    count: int
+    cursor: Optional[str]
+
 
 @annotate(supports_ws=True)
-def chat(account: Optional[Account], handler_factory: ChatHandlerFactory, session: Session, socket: Websocket):
+def chat(
+        identity: Optional[Identity],
+        handler_factory: ChatHandlerFactory,
+        socket: ChatWebsocket,
+        batch: Optional[QueryParam],
+):
+    if not identity:
+        raise HTTPError(HTTP_403, {"errors": "forbidden"})
+
+    # Clients that connect with ?batch=1 may get sent arrays of events.
+    handler = handler_factory(socket, identity.username, batched=batch == "1")
+    handler.handle_until_close()
+
+
+def list_members(
+        room_name: str,
+        account: Optional[Account],
+        registry: ChatroomRegistry,
+        cursor: Optional[QueryParam],
+        limit: Optional[QueryParam],
+) -> MembersPage:
     if not account:
         raise HTTPError(HTTP_403, {"errors": "forbidden"})
 
-    # Grab the username and close the DB session to avoid starvation.
-    username = account.username
-    session.close()
+    try:
+        limit = int(limit or MAX_MEMBERS_PER_PAGE)
+        if not 0 < limit <= MAX_MEMBERS_PER_PAGE:
+            raise ValueError()
+    except ValueError:
+        raise HTTPError(HTTP_400, {"errors": {
+            "limit": f"must be an integer between 1 and {MAX_MEMBERS_PER_PAGE}",
+        }})
 
-    handler = handler_factory(socket, username)
-    handler.handle_until_close()
+    # Clients pass the cursor of the previous page back in as-is to
+    # get the next one.
+    usernames, count, cursor = registry.get_members_page(room_name, limit, cursor)
+    return MembersPage(usernames=usernames, count=count, cursor=cursor)
 
 
 routes = [
-    Route("", chat)
+    Route("", chat),
+    Route("/rooms/{room_name}/members", list_members),
 ]
@@ -1,7 +1,7 @@
-from molten import HTTP_400, HTTPError, Route, schema
+from molten import HTTP_400, HTTPError, Route, Settings, schema
 from molten.contrib.sessions import Session
 
-from ..components.accounts import AccountManager
+from ..components.accounts import AccountManager, store_identity
 
 
 @schema
@@ -10,12 +10,18 @@ class SessionData:
     password: str
 
 
-def create_session(session: Session, session_data: SessionData, account_manager: AccountManager):
+def create_session(
+        session: Session,
+        session_data: SessionData,
+        account_manager: AccountManager,
+        settings: Settings,
+):
     account = account_manager.find_by_username_and_password(session_data.username, session_data.password)
     if not account:
         raise HTTPError(HTTP_400, {"errors": {"username": "invalid username or password"}})
 
     session["account_id"] = account.id
+    store_identity(session, account, settings.strict_get("accounts.identity_ttl"))
     return {}
 
 
@@ -0,0 +1,154 @@
+from bisect import bisect_left
+
+#: The default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+#: The content type of rendered metrics.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    __slots__ = ["labels", "value"]
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        yield name, self.labels, self.value
+
+
+class Histogram:
+    """Counts observations into fixed buckets.  Observing a value only
+    bumps a preallocated slot so it is cheap enough for hot paths.
+    """
+
+    __slots__ = ["buckets", "counts", "labels", "sum"]
+
+    def __init__(self, labels, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.labels = labels
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield f"{name}_bucket", self.labels + (("le", format_value(bound)),), cumulative
+
+        yield f"{name}_sum", self.labels, self.sum
+        yield f"{name}_count", self.labels, cumulative
+
+
+class Callback:
+    """A value that is read from somewhere else whenever metrics are
+    rendered, such as the size of a collection.
+    """
+
+    __slots__ = ["function", "labels"]
+
+    def __init__(self, labels, function):
+        self.function = function
+        self.labels = labels
+
+    def samples(self, name):
+        yield name, self.labels, self.function()
+
+
+class Family:
+    """A named metric along with its children, one per value of its
+    (optional) label.  Children for known label values should be
+    created up front via *values* so that looking them up never
+    allocates.
+    """
+
+    __slots__ = ["children", "help", "kind", "label", "make", "name"]
+
+    def __init__(self, name, kind, help, make, label=None, values=()):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.make = make
+        self.label = label
+        self.children = {}
+        for value in values:
+            self.labels(value)
+
+    def labels(self, value=None):
+        try:
+            return self.children[value]
+        except KeyError:
+            labels = ((self.label, value),) if self.label else ()
+            return self.children.setdefault(value, self.make(labels))
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for child in list(self.children.values()):
+            for name, labels, value in child.samples(self.name):
+                yield f"{name}{format_labels(labels)} {format_value(value)}"
+
+
+class Metrics:
+    """A per-worker collection of metrics that can be rendered in the
+    Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.families = {}
+
+    def register(self, family):
+        self.families[family.name] = family
+        return family
+
+    def counter(self, name, help, label=None, values=()):
+        family = self.register(Family(name, "counter", help, Counter, label, values))
+        return family if label else family.labels()
+
+    def histogram(self, name, help, label=None, values=(), buckets=DEFAULT_BUCKETS):
+        def make(labels):
+            return Histogram(labels, buckets)
+
+        family = self.register(Family(name, "histogram", help, make, label, values))
+        return family if label else family.labels()
+
+    def callback(self, name, help, function, kind="gauge"):
+        """Register a metric whose value is computed by calling
+        *function* at render time.  Registering a callback under an
+        existing name replaces it.
+        """
+        def make(labels):
+            return Callback(labels, function)
+
+        self.register(Family(name, kind, help, make)).labels()
+
+    def render(self):
+        lines = []
+        for family in list(self.families.values()):
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+#: The metrics of this worker.
+METRICS = Metrics()
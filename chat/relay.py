@@ -0,0 +1,299 @@
+"""A per-host relay that holds a single Redis subscription on behalf
+of every worker process on the host and forwards room events to them
+over a Unix socket.  Without it, Redis pushes every event once per
+worker that hosts sockets in the event's room.
+
+Run it with `scripts/relay` and point workers at it using the
+`relay.socket_path` setting.
+
+The relay and its workers exchange MessagePack arrays.  Workers send
+["subscribe", channel] and ["unsubscribe", channel].  The relay sends
+["subscribe", channel] once Redis has confirmed a subscription and
+["message", channel, data] for every event published to it.
+"""
+import fcntl
+import logging
+import os
+import socket
+import struct
+import termios
+from threading import Lock
+
+import gevent
+import msgpack
+from gevent.event import Event
+from gevent.queue import Full, Queue
+from gevent.server import StreamServer
+
+LOGGER = logging.getLogger(__name__)
+
+#: The number of frames that may be queued up for a worker before the
+#: relay gives up on it and drops its connection.
+MAX_PENDING_FRAMES = 10000
+
+#: The number of bytes read off of relay connections at a time.
+READ_SIZE = 65536
+
+
+def pack(*frame):
+    return msgpack.packb(frame, use_bin_type=True)
+
+
+def unread_bytes(sock):
+    """Get the number of bytes waiting to be read off of a socket.
+    """
+    unread, = struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.FIONREAD, b"\0" * 4))
+    return unread
+
+
+def listen_unix(path):
+    """Listen on a Unix socket at *path*, replacing any stale socket
+    left behind by a previous relay.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+    return listener
+
+
+class RelayConnection:
+    """A worker connected to the relay.  Frames are written to it by a
+    dedicated greenlet so that one slow worker can't hold up the rest.
+    """
+
+    __slots__ = ["channels", "queue", "socket", "writer"]
+
+    def __init__(self, sock, max_pending):
+        self.channels = set()
+        self.queue = Queue(max_pending)
+        self.socket = sock
+        self.writer = gevent.spawn(self.drain)
+
+    def send(self, frame):
+        try:
+            self.queue.put_nowait(frame)
+        except Full:
+            LOGGER.warning("Dropping worker that fell too far behind.")
+            self.close()
+
+    def drain(self):
+        while True:
+            frame = self.queue.get()
+            try:
+                self.socket.sendall(frame)
+            except OSError as e:
+                LOGGER.warning("Failed to write to worker: %s", e)
+                self.close()
+                return
+
+    def close(self):
+        # Shutting the socket down wakes up the reader, which then
+        # unsubscribes the worker from all of its channels.
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Relay:
+    """Subscribes to the union of the channels its workers want and
+    fans each event out to the workers that want it.  Workers are only
+    told that a subscription went through once Redis confirms it.
+    """
+
+    def __init__(self, redis, path, max_pending=MAX_PENDING_FRAMES):
+        self.max_pending = max_pending
+        self.pubsub = redis.pubsub()
+        self.pubsub_mutex = Lock()
+        self.connected = Event()
+        self.connections_by_channel = {}
+        self.confirmed_channels = set()
+        self.waiting_by_channel = {}
+        self.server = StreamServer(listen_unix(path), self.handle)
+        self.listener = None
+
+    def start(self):
+        self.server.start()
+        self.listener = gevent.spawn(self.listen)
+
+    def stop(self):
+        self.server.stop()
+        self.listener.kill()
+        self.pubsub.close()
+
+    def serve_forever(self):
+        self.start()
+        self.listener.join()
+
+    def handle(self, sock, address):
+        connection = RelayConnection(sock, self.max_pending)
+        unpacker = msgpack.Unpacker(raw=False)
+        try:
+            while True:
+                data = sock.recv(READ_SIZE)
+                if not data:
+                    return
+
+                unpacker.feed(data)
+                for command, channel in unpacker:
+                    if command == "subscribe":
+                        self.subscribe(connection, channel)
+                    elif command == "unsubscribe":
+                        self.unsubscribe(connection, channel)
+        except OSError as e:
+            LOGGER.warning("Failed to read from worker: %s", e)
+        finally:
+            for channel in list(connection.channels):
+                self.unsubscribe(connection, channel)
+
+            connection.writer.kill()
+            sock.close()
+
+    def subscribe(self, connection, channel):
+        if channel in connection.channels:
+            return
+
+        connection.channels.add(channel)
+        connections = self.connections_by_channel.setdefault(channel, set())
+        connections.add(connection)
+        if channel in self.confirmed_channels:
+            connection.send(pack("subscribe", channel))
+            return
+
+        self.waiting_by_channel.setdefault(channel, set()).add(connection)
+        if len(connections) == 1:
+            with self.pubsub_mutex:
+                self.pubsub.subscribe(channel)
+                self.connected.set()
+
+    def unsubscribe(self, connection, channel):
+        connection.channels.discard(channel)
+        connections = self.connections_by_channel.get(channel)
+        if connections is None:
+            return
+
+        connections.discard(connection)
+        self.waiting_by_channel.get(channel, set()).discard(connection)
+        if connections:
+            return
+
+        del self.connections_by_channel[channel]
+        self.confirmed_channels.discard(channel)
+        self.waiting_by_channel.pop(channel, None)
+        with self.pubsub_mutex:
+            self.pubsub.unsubscribe(channel)
+
+    def listen(self):
+        self.connected.wait()
+        while True:
+            try:
+                message = self.pubsub.handle_message(self.pubsub.parse_response())
+            except Exception:
+                LOGGER.exception("Failed to read from pubsub connection.")
+                gevent.sleep(1)
+                continue
+
+            if message is None:
+                continue
+
+            channel = message["channel"].decode()
+            if message["type"] == "subscribe" and channel in self.connections_by_channel:
+                self.confirmed_channels.add(channel)
+                frame = pack("subscribe", channel)
+                for connection in self.waiting_by_channel.pop(channel, ()):
+                    connection.send(frame)
+
+            elif message["type"] == "message":
+                # Each event is packed once no matter how many workers
+                # it gets forwarded to.
+                frame = pack("message", channel, message["data"])
+                for connection in list(self.connections_by_channel.get(channel, ())):
+                    connection.send(frame)
+
+
+class RelaySubscriber:
+    """Subscribes a worker to room channels through its host's relay.
+    Messages are handed out in the same shape as those of Redis pubsub
+    objects.  The connection to the relay is (re)established on read
+    and every subscription is replayed whenever it is.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.channels = set()
+        self.mutex = Lock()
+        self.socket = None
+        self.unpacker = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            with self.mutex:
+                for channel in self.channels:
+                    sock.sendall(pack("subscribe", channel))
+
+                self.socket = sock
+                self.unpacker = msgpack.Unpacker(raw=False)
+        except OSError:
+            sock.close()
+            raise
+
+    def close(self):
+        with self.mutex:
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+
+    def send(self, *frame):
+        with self.mutex:
+            # Subscriptions made while disconnected are sent as soon as
+            # the connection is reestablished.
+            if self.socket is None:
+                return
+
+            try:
+                self.socket.sendall(pack(*frame))
+            except OSError as e:
+                LOGGER.warning("Failed to write to relay: %s", e)
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+        self.send("subscribe", channel)
+
+    def unsubscribe(self, channel):
+        self.channels.discard(channel)
+        self.send("unsubscribe", channel)
+
+    def get_message(self):
+        if self.socket is None:
+            self.connect()
+
+        while True:
+            try:
+                command, channel, *data = next(self.unpacker)
+            except StopIteration:
+                pass
+            else:
+                message = {"type": command, "channel": channel.encode()}
+                if data:
+                    message["data"] = data[0]
+                return message
+
+            data = self.socket.recv(READ_SIZE)
+            if not data:
+                self.close()
+                raise ConnectionError("Relay closed the connection.")
+
+            self.unpacker.feed(data)
+
+    def get_backlog(self):
+        sock = self.socket
+        if sock is None:
+            return 0
+        return unread_bytes(sock)
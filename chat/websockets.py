@@ -0,0 +1,667 @@
+import json
+import logging
+import math
+import struct
+import time
+import zlib
+from collections import deque
+from functools import partial
+from typing import Optional
+
+import gevent
+import msgpack
+from gevent.event import Event
+from gevent.lock import Semaphore
+from molten import DependencyResolver, Environ, Request, Route
+from molten.contrib.websockets import (
+    CONTROL_FRAME_OPCODES, MAX_CONTROL_FRAME_PAYLOAD_SIZE, MAX_DATA_FRAME_PAYLOAD_SIZE, MAX_MESSAGE_SIZE,
+    OP_BINARY, OP_CLOSE, OP_CONTINUATION, OP_PING, OP_PONG, OP_TEXT, OPCODES, BinaryMessage, CloseMessage,
+    PingMessage, PongMessage, TextMessage, Websocket, WebsocketClosedError, WebsocketMessageTooLargeError,
+    WebsocketProtocolError, WebsocketsMiddleware, _DataFrame, _DataFrameHeader
+)
+
+LOGGER = logging.getLogger(__name__)
+
+#: Make room for new messages by discarding the oldest queued message.
+DROP_OLDEST = "drop_oldest"
+
+#: Disconnect clients whose queue fills up.
+DROP_CONNECTION = "drop_connection"
+
+#: The set of supported outbox overflow policies.
+OVERFLOW_POLICIES = {DROP_OLDEST, DROP_CONNECTION}
+
+
+#: The frame flag that marks a message as compressed under
+#: permessage-deflate.
+RSV1 = 0x40
+
+#: Payloads smaller than this many bytes are sent uncompressed even
+#: to clients that negotiated compression.
+DEFLATE_MIN_SIZE = 128
+
+#: The trailer that permessage-deflate strips from compressed payloads.
+DEFLATE_TRAILER = b"\x00\x00\xff\xff"
+
+
+def frame_header(opcode, length, flags=0):
+    """Build the header of a final, unmasked data frame.
+    """
+    if length < 126:
+        return struct.pack("!BB", 0x80 | flags | opcode, length)
+
+    elif length <= 0xFFFF:
+        return struct.pack("!BBH", 0x80 | flags | opcode, 126, length)
+
+    return struct.pack("!BBQ", 0x80 | flags | opcode, 127, length)
+
+
+class Codec:
+    """A format that messages can be exchanged in.
+    """
+
+    __slots__ = ["decode", "encode", "join", "opcode"]
+
+    def __init__(self, opcode, encode, decode, join):
+        self.decode = decode
+        self.encode = encode
+        self.join = join
+        self.opcode = opcode
+
+
+def join_json(payloads):
+    return b"[" + b",".join(payloads) + b"]"
+
+
+def join_msgpack(payloads):
+    packer = msgpack.Packer()
+    return packer.pack_array_header(len(payloads)) + b"".join(payloads)
+
+
+#: Messages are exchanged as JSON in text frames.  This is the default
+#: for clients that don't ask for a subprotocol.
+JSON_CODEC = Codec(OP_TEXT, lambda data: json.dumps(data).encode("utf-8"), json.loads, join_json)
+
+#: Messages are exchanged as MessagePack in binary frames.
+MSGPACK_CODEC = Codec(
+    OP_BINARY,
+    partial(msgpack.packb, use_bin_type=True),
+    partial(msgpack.unpackb, raw=False),
+    join_msgpack,
+)
+
+#: The subprotocols clients may ask for, mapped to their codecs.
+SUBPROTOCOLS = {
+    "chat.msgpack": MSGPACK_CODEC,
+    "chat.json": JSON_CODEC,
+}
+
+
+def deflate(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-len(DEFLATE_TRAILER)]
+
+
+class WireMessage:
+    """A server-to-client message that gets encoded and framed at most
+    once per wire format, no matter how many sockets it's sent to.
+    Compression never carries context over between messages, so the
+    same compressed frame can be shared by every socket as well.
+    """
+
+    __slots__ = ["data", "delivery", "frames", "payloads"]
+
+    def __init__(self, data, delivery=None):
+        self.data = data
+        self.delivery = delivery
+        self.frames = {}
+        self.payloads = {}
+
+    def done(self):
+        """Called by outboxes once they're done with this message,
+        whether they wrote it or dropped it.
+        """
+        if self.delivery is not None:
+            self.delivery.done()
+
+    def get_payload(self, codec):
+        try:
+            return self.payloads[codec]
+        except KeyError:
+            payload = self.payloads[codec] = codec.encode(self.data)
+            return payload
+
+    def get_frame(self, codec, compress):
+        try:
+            return self.frames[codec, compress]
+        except KeyError:
+            pass
+
+        flags, payload = 0, self.get_payload(codec)
+        if compress and len(payload) >= DEFLATE_MIN_SIZE:
+            flags, payload = RSV1, deflate(payload)
+
+        frame = self.frames[codec, compress] = frame_header(codec.opcode, len(payload), flags) + payload
+        return frame
+
+    def to_stream(self, stream):
+        stream.write(self.get_frame(JSON_CODEC, False))
+
+
+class WireBatch(WireMessage):
+    """A group of messages sent to a single socket as one array frame.
+    The batch is assembled out of its messages' encoded payloads so
+    each message is still only ever encoded once per wire format.
+    """
+
+    __slots__ = []
+
+    def get_payload(self, codec):
+        return codec.join([message.get_payload(codec) for message in self.data])
+
+    def done(self):
+        for message in self.data:
+            message.done()
+
+
+#: The ping sent to peers that have gone quiet.
+PING_MESSAGE = PingMessage()
+
+
+class OutboxCounters:
+    """Per-worker counts of how often outboxes misbehave.
+    """
+
+    __slots__ = ["dead_peers", "dropped_connections", "dropped_messages", "failed_writes"]
+
+    def __init__(self):
+        self.dead_peers = 0
+        self.dropped_connections = 0
+        self.dropped_messages = 0
+        self.failed_writes = 0
+
+
+#: The counters shared by every outbox in this worker.
+COUNTERS = OutboxCounters()
+
+
+class Outbox:
+    """A bounded queue of outbound messages for a single websocket.
+
+    Messages are written to the socket by a dedicated greenlet so
+    that senders never block on slow clients.  When a client falls
+    more than *max_size* messages behind, *overflow_policy* decides
+    whether its oldest message or its connection gets dropped.
+
+    With a non-zero *batch_window*, the writer waits up to that many
+    seconds after being woken up so that messages queued up in the
+    meantime can be sent together as a single WireBatch.
+    """
+
+    __slots__ = [
+        "batch_window", "closed", "max_size", "overflow_policy", "paused", "queue", "ready", "socket", "writer",
+    ]
+
+    def __init__(self, socket, *, max_size, overflow_policy, batch_window=0):
+        self.batch_window = batch_window
+        self.closed = False
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.paused = False
+        self.queue = deque()
+        self.ready = Event()
+        self.socket = socket
+        self.writer = gevent.spawn(self.drain)
+
+    def send(self, message):
+        """Queue a message for delivery.
+
+        Raises:
+          WebsocketClosedError: If the outbox was closed or if the
+            client got disconnected for falling too far behind.
+        """
+        if self.closed:
+            raise WebsocketClosedError("Outbox already closed.")
+
+        if len(self.queue) >= self.max_size:
+            if self.overflow_policy == DROP_CONNECTION:
+                COUNTERS.dropped_connections += 1
+                self.abort()
+                raise WebsocketClosedError("Client fell too far behind.")
+
+            COUNTERS.dropped_messages += 1
+            self.finish(self.queue.popleft())
+
+        self.queue.append(message)
+        self.ready.set()
+
+    def send_first(self, messages):
+        """Queue up messages ahead of any pending ones.  These never
+        count towards the outbox's size limit.
+        """
+        if self.closed:
+            raise WebsocketClosedError("Outbox already closed.")
+
+        self.queue.extendleft(reversed(messages))
+        self.ready.set()
+
+    def pause(self):
+        """Hold on to queued messages until resume() is called.
+        """
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.ready.set()
+
+    def drain(self):
+        while not self.closed:
+            self.ready.wait()
+            if self.batch_window:
+                gevent.sleep(self.batch_window)
+
+            self.ready.clear()
+            while self.queue and not self.paused:
+                message = self.next_batch() if self.batch_window else self.queue.popleft()
+                try:
+                    self.socket.send(message)
+                except WebsocketClosedError:
+                    self.closed = True
+                    return
+                except Exception as e:
+                    LOGGER.warning(".send() failed on socket: %s", e)
+                    COUNTERS.failed_writes += 1
+                    self.abort()
+                    return
+                finally:
+                    self.finish(message)
+
+    def next_batch(self):
+        """Pop the next message off the queue, along with every wire
+        message right behind it if it's a wire message itself.
+        """
+        message = self.queue.popleft()
+        if type(message) is not WireMessage:
+            return message
+
+        messages = [message]
+        while self.queue and type(self.queue[0]) is WireMessage:
+            messages.append(self.queue.popleft())
+
+        if len(messages) == 1:
+            return message
+
+        return WireBatch(messages)
+
+    def finish(self, message):
+        if isinstance(message, WireMessage):
+            message.done()
+
+    def close(self):
+        """Stop accepting messages and discard any pending ones.
+        """
+        self.closed = True
+        while self.queue:
+            self.finish(self.queue.popleft())
+        self.ready.set()
+
+    def abort(self):
+        """Close the outbox and tear down the underlying connection
+        without waiting on the client.
+        """
+        self.close()
+        if not self.socket.closed:
+            self.socket.closed = True
+            self.socket.stream.close()
+
+
+class _ActivityTrackingSocket:
+    """Wraps a websocket's underlying socket in order to record when
+    data was last received from it, including control frames that
+    never make it out of Websocket.receive().
+    """
+
+    __slots__ = ["peer", "socket"]
+
+    def __init__(self, socket, peer):
+        self.peer = peer
+        self.socket = socket
+
+    def recv(self, n):
+        data = self.socket.recv(n)
+        self.peer.last_seen = time.monotonic()
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+
+class Peer:
+    """A connection being watched by a TimerWheel.
+    """
+
+    __slots__ = ["last_seen", "outbox", "slot"]
+
+    def __init__(self, outbox):
+        self.last_seen = time.monotonic()
+        self.outbox = outbox
+        self.slot = None
+
+
+class TimerWheel:
+    """Keeps an eye on every connection in a worker using a single
+    greenlet.  Peers are filed into slots by when they next need to be
+    looked at and every *tick* seconds the wheel turns by one slot.
+    Peers that have been quiet for *ping_interval* seconds get pinged
+    and peers that have been quiet for *idle_timeout* seconds get
+    disconnected.  Activity only ever updates a timestamp, so busy
+    peers cost nothing until their slot comes up.
+    """
+
+    __slots__ = ["idle_timeout", "ping_interval", "position", "slots", "tick", "turner"]
+
+    def __init__(self, *, tick, ping_interval, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.position = 0
+        self.slots = [set() for _ in range(math.ceil(idle_timeout / tick) + 1)]
+        self.tick = tick
+        self.turner = gevent.spawn(self.turn_forever)
+
+    def watch(self, outbox):
+        peer = Peer(outbox)
+        stream = outbox.socket.stream
+        stream.socket = _ActivityTrackingSocket(stream.socket, peer)
+        self.schedule(peer, self.ping_interval)
+        return peer
+
+    def unwatch(self, peer):
+        if peer.slot is not None:
+            self.slots[peer.slot].discard(peer)
+            peer.slot = None
+
+    def schedule(self, peer, delay):
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+        peer.slot = (self.position + ticks) % len(self.slots)
+        self.slots[peer.slot].add(peer)
+
+    def turn(self):
+        self.position = (self.position + 1) % len(self.slots)
+        peers, self.slots[self.position] = self.slots[self.position], set()
+        now = time.monotonic()
+        for peer in peers:
+            peer.slot = None
+            idle_time = now - peer.last_seen
+            if idle_time >= self.idle_timeout:
+                COUNTERS.dead_peers += 1
+                peer.outbox.abort()
+                continue
+
+            if idle_time >= self.ping_interval:
+                try:
+                    peer.outbox.send(PING_MESSAGE)
+                except WebsocketClosedError:
+                    continue
+
+                self.schedule(peer, self.idle_timeout - idle_time)
+
+            else:
+                self.schedule(peer, self.ping_interval - idle_time)
+
+    def turn_forever(self):
+        while True:
+            gevent.sleep(self.tick)
+            try:
+                self.turn()
+            except Exception:
+                LOGGER.exception("Failed to turn timer wheel.")
+
+
+class ChatWebsocket(Websocket):
+    """A websocket that speaks whichever codec was negotiated during
+    the handshake and optionally compresses its messages.
+
+    Messages are written by the outbox's greenlet, whereas pongs and
+    close frames are written by whichever greenlet is reading from the
+    socket, so writes are serialized in order to keep their frames
+    from getting interleaved.
+    """
+
+    __slots__ = ["codec", "compress", "decompressor", "write_lock"]
+
+    def __init__(self, stream, codec=JSON_CODEC, compress=False):
+        super().__init__(stream)
+        self.codec = codec
+        self.compress = compress
+        self.decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS) if compress else None
+        self.write_lock = Semaphore()
+
+    def decode(self, message):
+        return self.codec.decode(message.get_data())
+
+    def send(self, message):
+        with self.write_lock:
+            if self.closed:
+                raise WebsocketClosedError("Websocket already closed.")
+
+            if isinstance(message, WireMessage):
+                self.stream.write(message.get_frame(self.codec, self.compress))
+            else:
+                message.to_stream(self.stream)
+
+    def read_frame(self):
+        """Reads a single data frame.  Mirrors _DataFrame.from_stream()
+        from molten 0.7.1, which rejects frames with RSV1 set.
+        """
+        header = _DataFrameHeader.from_stream(self.stream)
+        if header.opcode not in OPCODES:
+            raise WebsocketProtocolError(f"Invalid opcode 0x{header.opcode:x}.")
+
+        # Only the first frame of a compressed message may be flagged.
+        allowed_flags = RSV1 if self.compress and header.opcode in (OP_TEXT, OP_BINARY) else 0
+        if header.flags & ~allowed_flags:
+            raise WebsocketProtocolError("Reserved flags must not be set.")
+
+        if header.opcode in CONTROL_FRAME_OPCODES:
+            max_size = MAX_CONTROL_FRAME_PAYLOAD_SIZE
+        else:
+            max_size = MAX_DATA_FRAME_PAYLOAD_SIZE
+
+        if header.length > max_size:
+            raise WebsocketMessageTooLargeError(f"Payload exceeds {max_size} bytes.")
+
+        data = self.stream.expect(header.length)
+        if header.mask:
+            data = header.mask_data(data)
+
+        return _DataFrame(header, data)
+
+    def inflate(self, message):
+        data = self.decompressor.decompress(message.get_data() + DEFLATE_TRAILER, MAX_MESSAGE_SIZE)
+        if self.decompressor.unconsumed_tail:
+            raise WebsocketMessageTooLargeError(f"Message exceeds {MAX_MESSAGE_SIZE} bytes.")
+
+        message.buf.seek(0)
+        message.buf.truncate()
+        message.buf.write(data)
+        return message
+
+    def receive(self, *, timeout=None):
+        """Waits for a message from the client for up to *timeout*
+        seconds.  Works just like Websocket.receive() from molten 0.7.1
+        except that it also accepts compressed messages.
+        """
+        if self.closed:
+            return None
+
+        with gevent.Timeout(timeout):
+            message, compressed = None, False
+            while True:
+                frame = self.read_frame()
+                if frame.header.opcode in (OP_TEXT, OP_BINARY):
+                    if message is not None:
+                        raise WebsocketProtocolError("Unexpected data frame.")
+
+                    message_type = TextMessage if frame.header.opcode == OP_TEXT else BinaryMessage
+                    message = message_type.from_frame(frame)
+                    compressed = frame.header.flags & RSV1 == RSV1
+
+                elif frame.header.opcode == OP_CONTINUATION:
+                    if message is None:
+                        raise WebsocketProtocolError("Unexpected continuation frame.")
+
+                    message.add_frame(frame)
+
+                elif frame.header.opcode == OP_CLOSE:
+                    if not frame.header.fin:
+                        raise WebsocketProtocolError("Close frame is not final.")
+
+                    message = CloseMessage.from_frame(frame)
+                    self.close(CloseMessage(reason=message.get_text()))
+                    return message
+
+                elif frame.header.opcode == OP_PING:
+                    if not frame.header.fin:
+                        raise WebsocketProtocolError("Ping frame is not final.")
+
+                    self.send(PongMessage(frame.data))
+                    continue
+
+                elif frame.header.opcode == OP_PONG:
+                    if not frame.header.fin:
+                        raise WebsocketProtocolError("Pong frame is not final.")
+
+                    continue
+
+                if frame.header.fin:
+                    return self.inflate(message) if compressed else message
+
+
+def negotiate_subprotocol(header):
+    """Pick the first subprotocol offered by a client that we support.
+    Returns None and the JSON codec if there isn't one.
+    """
+    for subprotocol in (header or "").split(","):
+        subprotocol = subprotocol.strip()
+        if subprotocol in SUBPROTOCOLS:
+            return subprotocol, SUBPROTOCOLS[subprotocol]
+
+    return None, JSON_CODEC
+
+
+def negotiate_compression(header):
+    """Returns True if a client offered permessage-deflate on terms we
+    can accept.  We never compress with a reduced window and always
+    reset our compression context between messages.
+    """
+    for offer in (header or "").split(","):
+        name, *params = [part.strip() for part in offer.split(";")]
+        if name != "permessage-deflate":
+            continue
+
+        for param in params:
+            key, _, value = param.partition("=")
+            if key in ("client_max_window_bits", "client_no_context_takeover", "server_no_context_takeover"):
+                continue
+
+            if key == "server_max_window_bits" and value.strip('"') == str(zlib.MAX_WBITS):
+                continue
+
+            break
+        else:
+            return True
+
+    return False
+
+
+class _UpgradeResponseSocket:
+    """Wraps an upgraded connection's socket in order to add the
+    negotiated headers to the upgrade response molten writes to it.
+    """
+
+    __slots__ = ["headers", "recv", "sendall", "socket"]
+
+    def __init__(self, socket, headers):
+        self.headers = headers
+        self.recv = socket.recv
+        self.sendall = self.send_upgrade_response
+        self.socket = socket
+
+    def send_upgrade_response(self, data):
+        # The upgrade response is the first thing written to the
+        # socket and it ends in a blank line.  Everything after it
+        # goes straight to the socket.
+        self.sendall = self.socket.sendall
+        self.socket.sendall(data[:-2] + self.headers + b"\r\n")
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+
+class ChatWebsocketComponent:
+    """Resolves the ChatWebsocket of an upgraded connection.  It takes
+    the connection over from the Websocket molten set up for it.
+    """
+
+    __slots__ = ["codec", "compress", "websocket"]
+
+    is_cacheable = True
+    is_singleton = False
+
+    def __init__(self, codec, compress):
+        self.codec = codec
+        self.compress = compress
+        self.websocket = None
+
+    def can_handle_parameter(self, parameter):
+        return parameter.annotation is ChatWebsocket
+
+    def resolve(self, websocket: Websocket):
+        # molten closes its own Websocket once the handler returns, so
+        # it's marked closed here and the middleware closes ours instead.
+        websocket.closed = True
+        self.websocket = ChatWebsocket(websocket.stream, self.codec, self.compress)
+        return self.websocket
+
+
+class ChatWebsocketsMiddleware(WebsocketsMiddleware):
+    """Extends molten's websockets middleware with subprotocol and
+    permessage-deflate negotiation.  Websocket handlers must ask for
+    a ChatWebsocket rather than a Websocket.
+
+    molten handles the upgrade itself, so this relies on how molten
+    0.7.1 writes its upgrade response and closes its Websocket.
+    Revisit it when upgrading molten.
+    """
+
+    __slots__ = []
+
+    def __call__(self, handler):
+        handle_upgrade = super().__call__(handler)
+
+        def handle(resolver: DependencyResolver, request: Request, environ: Environ, route: Optional[Route]):
+            if route is None or not getattr(route.handler, "supports_ws", False):
+                return handler()
+
+            subprotocol, codec = negotiate_subprotocol(request.headers.get("sec-websocket-protocol"))
+            compress = negotiate_compression(request.headers.get("sec-websocket-extensions"))
+            headers = b""
+            if subprotocol is not None:
+                headers += f"sec-websocket-protocol: {subprotocol}\r\n".encode()
+
+            if compress:
+                headers += b"sec-websocket-extensions: permessage-deflate; server_no_context_takeover\r\n"
+
+            if headers:
+                environ["gunicorn.socket"] = _UpgradeResponseSocket(environ["gunicorn.socket"], headers)
+
+            component = ChatWebsocketComponent(codec, compress)
+            resolver.add_component(component)
+
+            try:
+                return handle_upgrade(resolver, request, environ, route)
+            finally:
+                if component.websocket is not None:
+                    component.websocket.close(CloseMessage())
+        return handle
@@ -1,5 +1,10 @@
 import logging
 import os
+import subprocess
+import sys
+
+from chat import settings
+from chat.common import path_to
 
 ENVIRONMENT = os.getenv("ENVIRONMENT", "dev")
 DEBUG = ENVIRONMENT == "dev"
@@ -19,3 +24,17 @@ worker_connections = 1000
 errorlog = "-"
 accesslog = "-"
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
+
+
+def on_starting(server):
+    # Workers can share a single subscription to room events through a
+    # relay process running alongside them.  See chat/relay.py.
+    if settings.strict_get("relay.socket_path"):
+        server.relay = subprocess.Popen([sys.executable, path_to("scripts", "relay")])
+
+
+def on_exit(server):
+    relay = getattr(server, "relay", None)
+    if relay is not None:
+        relay.terminate()
+        relay.wait()
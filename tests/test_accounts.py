@@ -0,0 +1,191 @@
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from molten import Settings
+
+from chat.components.accounts import AccountCache, AccountManager, CredentialCache
+from chat.components.passwords import PasswordHasher
+from chat.components.redis import Redis
+from chat.metrics import METRICS
+from chat.settings import SETTINGS
+
+
+def test_basic_auth_credentials_are_cached(app, account, account_auth, client, load_component, monkeypatch):
+    checks = []
+    original_check = PasswordHasher.check
+
+    def check(self, password_hash, password):
+        checks.append(password)
+        return original_check(self, password_hash, password)
+
+    monkeypatch.setattr(PasswordHasher, "check", check)
+
+    # Given that I've made a request using Basic auth
+    response = client.get(app.reverse_uri("v1:chat:list_members", room_name="gotham"), auth=account_auth)
+    assert response.status_code == 200
+    assert len(checks) == 1
+
+    # When I make another request with the same credentials
+    response = client.get(app.reverse_uri("v1:chat:list_members", room_name="gotham"), auth=account_auth)
+
+    # Then it should succeed without my password being checked again
+    assert response.status_code == 200
+    assert len(checks) == 1
+
+    # When my password changes
+    account_manager = load_component(AccountManager)
+    account_manager.change_password(account_manager.find_by_id(account.id), "alfredknows")
+
+    # Then my old credentials should no longer be accepted
+    response = client.get(app.reverse_uri("v1:chat:list_members", room_name="gotham"), auth=account_auth)
+    assert response.status_code == 403
+    assert len(checks) == 2
+
+
+def test_password_changes_invalidate_credentials_on_every_worker(app, account, load_component):
+    redis = load_component(Redis)
+    account_manager = load_component(AccountManager)
+    settings = {"max_size": 16, "ttl": 60}
+
+    # Given that my credentials were verified by another worker
+    other_cache = CredentialCache(redis, **settings)
+    _, version = other_cache.get("jim.gordon", "bruceisbatman")
+    other_cache.put("jim.gordon", "bruceisbatman", account, version)
+    cached_account, _ = other_cache.get("jim.gordon", "bruceisbatman")
+    assert cached_account.id == account.id
+
+    # When my password is changed by this worker
+    account_manager.change_password(account_manager.find_by_id(account.id), "alfredknows")
+
+    # Then the other worker should stop accepting my old credentials
+    cached_account, _ = other_cache.get("jim.gordon", "bruceisbatman")
+    assert cached_account is None
+
+
+def test_logins_are_turned_away_when_hashing_is_saturated(app, account, client, load_component):
+    password_hasher = load_component(PasswordHasher)
+
+    # Given that every hashing slot is taken
+    acquired = 0
+    while password_hasher.slots.acquire(blocking=False):
+        acquired += 1
+
+    try:
+        # When I try to log in
+        response = client.post(
+            app.reverse_uri("v1:sessions:create_session"),
+            json={"username": "jim.gordon", "password": "bruceisbatman"},
+        )
+
+        # Then I should be told to try again later
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+    finally:
+        for _ in range(acquired):
+            password_hasher.slots.release()
+
+    # When a slot frees up and I try again
+    response = client.post(
+        app.reverse_uri("v1:sessions:create_session"),
+        json={"username": "jim.gordon", "password": "bruceisbatman"},
+    )
+
+    # Then I should be logged in
+    assert response.status_code == 200
+
+
+def test_hashing_recovers_from_broken_process_pools():
+    password_hasher = PasswordHasher(Settings({**SETTINGS, "hashing": {**SETTINGS["hashing"], "workers": 1}}))
+    try:
+        # Given that the hashing subprocess has died
+        with pytest.raises(BrokenProcessPool):
+            password_hasher.executor.submit(os._exit, 1).result()
+
+        # When a password is hashed
+        password_hash = password_hasher.hash("bruceisbatman")
+
+        # Then it should be hashed on a new pool
+        assert password_hasher.check(password_hash, "bruceisbatman")
+    finally:
+        password_hasher.executor.shutdown()
+
+
+def test_account_lookups_are_cached(app, account, load_component):
+    account_manager = load_component(AccountManager)
+    account_cache = load_component(AccountCache)
+    hits, misses = account_cache.counters.hits, account_cache.counters.misses
+
+    # Given that my account has been looked up once
+    assert account_manager.find_by_id(account.id).username == "jim.gordon"
+    assert account_cache.counters.misses == misses + 1
+
+    # When it's looked up again
+    found_account = account_manager.find_by_id(account.id)
+
+    # Then it should come from the cache
+    assert found_account.username == "jim.gordon"
+    assert account_cache.counters.hits == hits + 1
+
+    # When my password changes
+    account_manager.change_password(found_account, "alfredknows")
+
+    # Then the next lookup should go back to the database
+    account_manager.find_by_id(account.id)
+    assert account_cache.counters.misses == misses + 2
+
+    # And my new password should work
+    assert account_manager.find_by_username_and_password("jim.gordon", "alfredknows")
+
+
+def test_account_lookups_can_be_shared_between_workers(app, account, load_component):
+    redis = load_component(Redis)
+    loads = []
+
+    def load(account_id):
+        loads.append(account_id)
+        return account
+
+    # Given two workers' account caches backed by Redis
+    cache_1 = AccountCache(redis, max_size=16, ttl=60)
+    cache_2 = AccountCache(redis, max_size=16, ttl=60)
+
+    # When both of them look up the same account
+    cache_1.get(account.id, load)
+    found_account = cache_2.get(account.id, load)
+
+    # Then it should only be loaded from the database once
+    assert found_account.username == "jim.gordon"
+    assert loads == [account.id]
+    assert cache_2.counters.shared_hits == 1
+
+    # When one of them invalidates it
+    cache_1.invalidate(account.id)
+
+    # Then it should be gone from Redis as well
+    assert not redis.exists(f"chat:accounts:{account.id}")
+
+
+def test_account_cache_counters_are_exported(app, account, load_component, monkeypatch):
+    # Given the worker's account cache, which can only hold a single account
+    account_cache = load_component(AccountCache)
+    account_cache.entries.clear()
+    monkeypatch.setattr(account_cache, "max_size", 1)
+
+    # And another account cache, such as the one of another worker
+    AccountCache(None, max_size=1, ttl=60)
+
+    # When an account is looked up twice and then pushed out by another
+    account_cache.get(account.id, lambda account_id: account)
+    account_cache.get(account.id, lambda account_id: account)
+    account_cache.get(account.id + 1, lambda account_id: account)
+
+    # Then the worker's cache's counters should show up in its metrics
+    counters = account_cache.counters
+    output = METRICS.render()
+    assert f"chat_account_cache_hits_total {counters.hits}\n" in output
+    assert f"chat_account_cache_shared_hits_total {counters.shared_hits}\n" in output
+    assert f"chat_account_cache_misses_total {counters.misses}\n" in output
+    assert f"chat_account_cache_evictions_total {counters.evictions}\n" in output
+    assert counters.evictions > 0
+    assert "chat_account_cache_entries 1\n" in output
@@ -1,15 +1,29 @@
 import json
+import time
 
+import gevent
+import pytest
+from gevent import Timeout
+from molten.contrib.sqlalchemy import SQLAlchemySessionComponent
 from molten.contrib.websockets import TextMessage
 
+from chat.components.chatrooms import ChatroomListener, ChatroomRegistry
+from chat.components.ratelimits import RateLimiter
+from chat.components.redis import Redis
+
 
 def JsonMessage(*, type, **kwargs):
     return TextMessage(json.dumps({"type": type, **kwargs}))
 
 
+def without_id(message):
+    message.pop("id", None)
+    return message
+
+
 def test_pings(app, account, account_auth, client_ws):
     def read_messages(n):
-        return [json.loads(sock.receive(timeout=1).get_text()) for _ in range(n)]
+        return [without_id(json.loads(sock.receive(timeout=1).get_text())) for _ in range(n)]
 
     # Given that I have an account
     with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
@@ -22,9 +36,32 @@ def test_pings(app, account, account_auth, client_ws):
         assert {"type": "pong"} in messages
 
 
+def test_chat_with_session_cookie(app, account, client, client_ws, monkeypatch):
+    # Given that I've logged in
+    response = client.post(
+        app.reverse_uri("v1:sessions:create_session"),
+        json={"username": "jim.gordon", "password": "bruceisbatman"},
+    )
+    cookie, _, _ = response.headers["set-cookie"].partition(";")
+
+    # And the database is unavailable
+    def resolve(*args, **kwargs):
+        raise AssertionError("The database should not be used.")
+
+    monkeypatch.setattr(SQLAlchemySessionComponent, "resolve", resolve)
+
+    # When I connect to the chat using my session cookie
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), headers={"cookie": cookie}) as sock:
+        sock.send(JsonMessage(type="join", room_name="batcave"))
+
+        # Then I should be able to join rooms as myself
+        message = without_id(json.loads(sock.receive(timeout=1).get_text()))
+        assert message == {"type": "join", "username": "jim.gordon"}
+
+
 def test_chat(app, account, account_auth, alt_account, alt_account_auth, client_ws):
     def read_messages(n):
-        return [json.loads(sock.receive(timeout=1).get_text()) for _ in range(n)]
+        return [without_id(json.loads(sock.receive(timeout=1).get_text())) for _ in range(n)]
 
     account_username = "jim.gordon"
     alt_account_username = "bruce.wayne"
@@ -71,3 +108,353 @@ def test_chat(app, account, account_auth, alt_account, alt_account_auth, client_
                 {"type": "leave", "username": alt_account_username},
                 {"type": "presence", "usernames": [account_username]},
             ]
+
+
+def test_room_subscriptions(app, account, account_auth, client_ws, load_component):
+    def read_messages(n):
+        return [without_id(json.loads(sock.receive(timeout=1).get_text())) for _ in range(n)]
+
+    def count_subscribers(room_name):
+        channel = f"chat:events:{room_name}"
+        [(_, count)] = redis.pubsub_numsub(channel)
+        return count
+
+    redis = load_component(Redis)
+
+    # Given that I have an account
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+        # When I join the "general" chatroom
+        sock.send(JsonMessage(type="join", room_name="general"))
+        read_messages(2)
+
+        # Then the worker should be subscribed to that room's channel
+        assert count_subscribers("general") == 1
+        # And it shouldn't be subscribed to any other room's channel
+        assert count_subscribers("random") == 0
+
+        # When I leave the room
+        sock.send(JsonMessage(type="leave", room_name="general"))
+        sock.send(JsonMessage(type="ping", room_name="general"))
+        assert read_messages(1) == [{"type": "pong"}]
+
+        # Then the worker should no longer be subscribed to its channel
+        assert count_subscribers("general") == 0
+
+
+def test_chat_presence_deltas(app, account, account_auth, alt_account, alt_account_auth, client_ws):
+    def read_messages(n):
+        return [without_id(json.loads(sock.receive(timeout=1).get_text())) for _ in range(n)]
+
+    account_username = "jim.gordon"
+    alt_account_username = "bruce.wayne"
+
+    # Given that I have an account
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+        # When I join the "gotham" chatroom in delta presence mode
+        sock.send(JsonMessage(type="join", room_name="gotham", presence="delta"))
+
+        # Then I should get back a snapshot of the room's members
+        # And a message saying that I joined
+        # And a delta adding me to the room
+        messages = read_messages(3)
+        assert messages == [
+            {"type": "presence_snapshot", "version": 0, "usernames": []},
+            {"type": "join", "username": account_username},
+            {"type": "presence_delta", "version": 1, "added": [account_username], "removed": []},
+        ]
+
+        # When someone else joins and then leaves the chat
+        with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=alt_account_auth) as alt_sock:
+            alt_sock.send(JsonMessage(type="join", room_name="gotham", presence="count"))
+            assert json.loads(alt_sock.receive(timeout=1).get_text()) == {"type": "presence_count", "count": 1}
+
+            # Then I should only receive the change to the member list
+            messages = read_messages(2)
+            assert messages == [
+                {"type": "join", "username": alt_account_username},
+                {"type": "presence_delta", "version": 2, "added": [alt_account_username], "removed": []},
+            ]
+
+
+def test_list_members(app, account, account_auth, alt_account, client, load_component):
+    redis = load_component(Redis)
+
+    # Given that a room has a few active members
+    # And one member that timed out
+    now = int(time.time())
+    usernames = ["jim.gordon", "bruce.wayne", "harvey.dent", "alfred.pennyworth"]
+    redis.zadd("chat:rooms:gotham", now - 3, "jim.gordon", now - 2, "bruce.wayne", now - 1, "alfred.pennyworth")
+    redis.zadd("chat:rooms:gotham", now - 3600, "harvey.dent")
+    redis.zadd("chat:roster:gotham", *(value for username in usernames for value in (0, username)))
+
+    # When I request the first page of its members
+    response = client.get(
+        app.reverse_uri("v1:chat:list_members", room_name="gotham"),
+        params={"limit": "2"},
+        auth=account_auth,
+    )
+
+    # Then I should get back the first active members by username
+    assert response.json() == {
+        "usernames": ["alfred.pennyworth", "bruce.wayne"],
+        "count": 3,
+        "cursor": "bruce.wayne",
+    }
+
+    # When the first member sends a heartbeat before I request the next page
+    redis.zadd("chat:rooms:gotham", now, "alfred.pennyworth")
+    response = client.get(
+        app.reverse_uri("v1:chat:list_members", room_name="gotham"),
+        params={"limit": "2", "cursor": "bruce.wayne"},
+        auth=account_auth,
+    )
+
+    # Then I should get back the remaining active members
+    assert response.json() == {
+        "usernames": ["jim.gordon"],
+        "count": 3,
+        "cursor": None,
+    }
+
+
+def test_chat_history(app, account, account_auth, alt_account, alt_account_auth, client_ws):
+    def read_messages(sock, n):
+        return [without_id(json.loads(sock.receive(timeout=1).get_text())) for _ in range(n)]
+
+    # Given that I have an account
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+        # And I've sent a couple of messages to the "gotham" chatroom
+        sock.send(JsonMessage(type="join", room_name="gotham"))
+        sock.send(JsonMessage(type="message", room_name="gotham", message="Hello!"))
+        sock.send(JsonMessage(type="message", room_name="gotham", message="Anyone here?"))
+        read_messages(sock, 4)
+
+        # When someone else joins the room
+        with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=alt_account_auth) as alt_sock:
+            alt_sock.send(JsonMessage(type="join", room_name="gotham"))
+
+            # Then they should get back the room's recent history
+            [history] = read_messages(alt_sock, 1)
+            assert history["type"] == "history"
+            assert history["cursor"] is None
+            assert [(m["username"], m["message"]) for m in history["messages"]] == [
+                ("jim.gordon", "Hello!"),
+                ("jim.gordon", "Anyone here?"),
+            ]
+
+
+def test_chat_resume(app, account, account_auth, alt_account, alt_account_auth, client_ws):
+    def read_messages(sock, n):
+        return [json.loads(sock.receive(timeout=1).get_text()) for _ in range(n)]
+
+    account_username = "jim.gordon"
+    alt_account_username = "bruce.wayne"
+
+    # Given that I've joined the "gotham" chatroom
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+        sock.send(JsonMessage(type="join", room_name="gotham"))
+        last_event_id = max(message["id"] for message in read_messages(sock, 2))
+
+    # And someone else joined and sent a message while I was disconnected
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=alt_account_auth) as alt_sock:
+        alt_sock.send(JsonMessage(type="join", room_name="gotham"))
+        alt_sock.send(JsonMessage(type="message", room_name="gotham", message="Hello!"))
+        read_messages(alt_sock, 3)
+
+        # When I reconnect and resume from the last event I got
+        with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+            sock.send(JsonMessage(type="join", room_name="gotham", resume_from=last_event_id))
+
+            # Then I should be told that my session was resumed
+            messages = read_messages(sock, 4)
+            assert messages[0]["type"] == "resume"
+            assert messages[0]["ok"]
+
+            # And I should get every event I missed
+            assert [without_id(message) for message in messages[1:3]] == [
+                {"type": "join", "username": alt_account_username},
+                {"type": "broadcast", "username": alt_account_username, "message": "Hello!"},
+            ]
+
+            # And the current list of members, which I never left
+            assert messages[3] == {"type": "presence", "usernames": sorted([account_username, alt_account_username])}
+
+            # And the others shouldn't be told that I left or joined again
+            with pytest.raises(Timeout):
+                alt_sock.receive(timeout=0.5)
+
+
+def test_chat_rate_limits(app, account, account_auth, client_ws, load_component, monkeypatch):
+    def read_messages(n):
+        return [without_id(json.loads(sock.receive(timeout=1).get_text())) for _ in range(n)]
+
+    # Given that I may only send a single message at a time
+    rate_limiter = load_component(RateLimiter)
+    monkeypatch.setitem(rate_limiter.limits, "message", {"user_rate": 0.1, "user_burst": 1})
+
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+        sock.send(JsonMessage(type="join", room_name="arkham"))
+        read_messages(2)
+
+        # When I send two messages back to back
+        sock.send(JsonMessage(type="message", room_name="arkham", message="Hello!"))
+        sock.send(JsonMessage(type="message", room_name="arkham", message="Hello?"))
+
+        # Then only the first one should be broadcast
+        # And I should be told that the second one was throttled
+        messages = read_messages(2)
+        assert {"type": "broadcast", "username": "jim.gordon", "message": "Hello!"} in messages
+        [rate_limited] = [message for message in messages if message["type"] == "rate_limited"]
+        assert rate_limited["event"] == "message"
+        assert rate_limited["room_name"] == "arkham"
+        assert rate_limited["retry_after"] > 0
+
+
+def test_slow_events_are_logged(app, account, account_auth, client_ws, load_component, monkeypatch, caplog):
+    # Given that every event counts as slow
+    listener = load_component(ChatroomListener)
+    monkeypatch.setattr(listener, "slow_event_threshold", 1e-9)
+
+    with client_ws.connect(
+        app.reverse_uri("v1:chat:chat"),
+        auth=account_auth,
+        headers={"x-request-id": "the-joker"},
+    ) as sock:
+        sock.send(JsonMessage(type="join", room_name="gotham-pd"))
+        sock.receive(timeout=1)
+
+        # When I send a message
+        sock.send(JsonMessage(type="message", room_name="gotham-pd", message="Hello!"))
+        sock.receive(timeout=1)
+        gevent.sleep(0.1)
+
+    # Then its delivery should be logged along with the request it came from
+    [record] = [
+        record for record in caplog.records
+        if record.getMessage().startswith("Slow 'broadcast' event")
+    ]
+    assert "across 1 sockets" in record.getMessage()
+    assert "request id: the-joker" in record.getMessage()
+
+
+def test_chat_with_multiple_connections(
+        app, account, account_auth, alt_account, alt_account_auth, client_ws, load_component, monkeypatch,
+):
+    def read_messages(sock, n):
+        return [without_id(json.loads(sock.receive(timeout=5).get_text())) for _ in range(n)]
+
+    registry = load_component(ChatroomRegistry)
+    monkeypatch.setattr(registry, "leave_grace_period", 0.1)
+
+    # Given that someone is watching the "wayne-tower" chatroom
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=alt_account_auth) as alt_sock:
+        alt_sock.send(JsonMessage(type="join", room_name="wayne-tower"))
+        read_messages(alt_sock, 2)
+
+        # And I've joined it
+        with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+            sock.send(JsonMessage(type="join", room_name="wayne-tower"))
+            read_messages(sock, 2)
+            assert read_messages(alt_sock, 2) == [
+                {"type": "join", "username": "jim.gordon"},
+                {"type": "presence", "usernames": ["bruce.wayne", "jim.gordon"]},
+            ]
+
+            # When I join it from another tab
+            with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as other_sock:
+                other_sock.send(JsonMessage(type="join", room_name="wayne-tower"))
+
+                # Then that tab should be sent the current list of members
+                assert read_messages(other_sock, 1) == [
+                    {"type": "presence", "usernames": ["bruce.wayne", "jim.gordon"]},
+                ]
+
+            # When I close one of the tabs and the grace period passes
+            gevent.sleep(0.5)
+
+            # Then they shouldn't be told that I left
+            with pytest.raises(Timeout):
+                alt_sock.receive(timeout=0.5)
+
+        # When I close the other tab
+        # Then they should be told that I left once the grace period passes
+        assert read_messages(alt_sock, 2) == [
+            {"type": "leave", "username": "jim.gordon"},
+            {"type": "presence", "usernames": ["bruce.wayne"]},
+        ]
+
+
+def test_chat_resume_after_leaving(
+        app, account, account_auth, alt_account, alt_account_auth, client_ws, load_component, monkeypatch,
+):
+    def read_messages(sock, n):
+        return [without_id(json.loads(sock.receive(timeout=5).get_text())) for _ in range(n)]
+
+    registry = load_component(ChatroomRegistry)
+    monkeypatch.setattr(registry, "leave_grace_period", 0)
+
+    # Given that someone is watching the "ace-chemicals" chatroom
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=alt_account_auth) as alt_sock:
+        alt_sock.send(JsonMessage(type="join", room_name="ace-chemicals"))
+        read_messages(alt_sock, 2)
+
+        # And I joined it
+        with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as new_sock:
+            with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+                sock.send(JsonMessage(type="join", room_name="ace-chemicals"))
+                last_event_id = max(json.loads(sock.receive(timeout=5).get_text())["id"] for _ in range(2))
+
+            # And they were told that I left
+            assert read_messages(alt_sock, 4)[2:] == [
+                {"type": "leave", "username": "jim.gordon"},
+                {"type": "presence", "usernames": ["bruce.wayne"]},
+            ]
+
+            # When I resume from the last event I got
+            new_sock.send(JsonMessage(type="join", room_name="ace-chemicals", resume_from=last_event_id))
+
+            # Then my session should be resumed
+            [resume] = read_messages(new_sock, 1)
+            assert resume["type"] == "resume"
+            assert resume["ok"]
+
+            # And they should be told that I joined again
+            assert read_messages(alt_sock, 2) == [
+                {"type": "join", "username": "jim.gordon"},
+                {"type": "presence", "usernames": ["bruce.wayne", "jim.gordon"]},
+            ]
+
+
+def test_chat_with_repeated_joins(
+        app, account, account_auth, alt_account, alt_account_auth, client_ws, load_component, monkeypatch,
+):
+    def read_messages(sock, n):
+        return [without_id(json.loads(sock.receive(timeout=5).get_text())) for _ in range(n)]
+
+    registry = load_component(ChatroomRegistry)
+    monkeypatch.setattr(registry, "leave_grace_period", 0)
+
+    # Given that someone is watching the "gcpd" chatroom
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=alt_account_auth) as alt_sock:
+        alt_sock.send(JsonMessage(type="join", room_name="gcpd"))
+        read_messages(alt_sock, 2)
+
+        # And I joined it twice from the same tab
+        with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+            sock.send(JsonMessage(type="join", room_name="gcpd"))
+            read_messages(sock, 2)
+            sock.send(JsonMessage(type="join", room_name="gcpd"))
+
+            # Then I should be sent the current list of members again
+            assert read_messages(sock, 1) == [
+                {"type": "presence", "usernames": ["bruce.wayne", "jim.gordon"]},
+            ]
+
+        # When I close the tab
+        # Then they should be told that I joined and left once
+        assert read_messages(alt_sock, 4) == [
+            {"type": "join", "username": "jim.gordon"},
+            {"type": "presence", "usernames": ["bruce.wayne", "jim.gordon"]},
+            {"type": "leave", "username": "jim.gordon"},
+            {"type": "presence", "usernames": ["bruce.wayne"]},
+        ]
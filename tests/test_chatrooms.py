@@ -0,0 +1,273 @@
+import json
+import time
+
+import gevent
+import pytest
+
+from chat.components.chatrooms import SEND_TO_ALL_FAILURES, ChatroomRegistry, EventMessage, HeartbeatBuffer
+from chat.components.history import RoomHistory
+from chat.components.ratelimits import RateLimiter
+from chat.components.redis import Redis
+
+
+def without_trace(event):
+    event.pop("trace", None)
+    return event
+
+
+def test_heartbeats_are_coalesced(app, load_component):
+    redis = load_component(Redis)
+
+    # Given a heartbeat buffer that never flushes by itself
+    heartbeats = HeartbeatBuffer(redis, flush_interval=3600)
+
+    # When members get touched many times
+    for _ in range(3):
+        heartbeats.touch("batcave", "jim.gordon")
+        heartbeats.touch("batcave", "bruce.wayne")
+        heartbeats.touch("arkham", "jim.gordon")
+
+    # Then nothing should be written to Redis
+    assert redis.zcard("chat:rooms:batcave") == 0
+
+    # And a single entry should be buffered per room and member
+    assert len(heartbeats.pending) == 3
+
+    # When the buffer is flushed
+    heartbeats.flush()
+
+    # Then every member should be present in their rooms
+    assert sorted(redis.zrange("chat:rooms:batcave", 0, -1)) == [b"bruce.wayne", b"jim.gordon"]
+    assert redis.zrange("chat:rooms:arkham", 0, -1) == [b"jim.gordon"]
+    assert not heartbeats.pending
+
+
+def test_presence_updates_are_coalesced(app, load_component):
+    redis = load_component(Redis)
+    registry = load_component(ChatroomRegistry)
+
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("chat:events:batcave")
+
+    # Given that a burst of members joins a room
+    for username in ["jim.gordon", "bruce.wayne", "alfred.pennyworth"]:
+        redis.zadd("chat:rooms:batcave", int(time.time()), username)
+        registry.schedule_presence_update("batcave")
+
+    # When the debounce window passes
+    gevent.sleep(registry.presence_debounce * 2)
+
+    # Then a single presence update should be published for the whole burst
+    events = []
+    deadline = time.monotonic() + 0.5
+    while time.monotonic() < deadline:
+        message = pubsub.get_message(timeout=0.1)
+        if message is not None:
+            events.append(without_trace(json.loads(message["data"])))
+
+    assert events == [
+        {"id": 1, "type": "presence", "args": ["batcave", 1, ["alfred.pennyworth", "bruce.wayne", "jim.gordon"], [], 3]},
+    ]
+
+
+def test_departures_wait_for_the_grace_period(app, load_component, monkeypatch):
+    redis = load_component(Redis)
+    registry = load_component(ChatroomRegistry)
+    monkeypatch.setattr(registry, "leave_grace_period", 0.1)
+
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("chat:events:wayne-manor")
+
+    def read_events():
+        events = []
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=0.1)
+            if message is not None:
+                events.append(without_trace(json.loads(message["data"])))
+        return events
+
+    # Given that two members of a room got disconnected
+    now = int(time.time())
+    redis.zadd("chat:rooms:wayne-manor", now, "bruce.wayne", now, "alfred.pennyworth")
+    redis.hmset("chat:connections:wayne-manor", {"bruce.wayne": 1, "alfred.pennyworth": 1})
+    registry.schedule_departure("wayne-manor", "bruce.wayne")
+    registry.schedule_departure("wayne-manor", "alfred.pennyworth")
+
+    # When one of them reconnects within the grace period
+    socket = object()
+    assert registry.add_member_to_room("wayne-manor", socket, "bruce.wayne")
+    registry.remove_member_from_all_rooms(socket)
+
+    # Then only the other one should be announced as having left
+    events = [event for event in read_events() if event["type"] != "presence"]
+    assert events == [
+        {"id": 1, "type": "leave", "args": ["wayne-manor", "alfred.pennyworth"]},
+    ]
+
+    # And only the one that reconnected should still be present
+    assert redis.zrange("chat:rooms:wayne-manor", 0, -1) == [b"bruce.wayne"]
+
+
+def test_messages_are_posted_in_a_single_step(app, load_component):
+    redis = load_component(Redis)
+    registry = load_component(ChatroomRegistry)
+    history = load_component(RoomHistory)
+
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("chat:events:batcave")
+
+    # When a member posts a message to a room
+    event_id, retry_after = registry.post_message("batcave", "bruce.wayne", "I'm Batman.", history.max_length)
+    assert retry_after == 0
+
+    # Then their presence should be refreshed
+    assert redis.zscore("chat:rooms:batcave", "bruce.wayne") >= int(time.time()) - 1
+
+    # And the message should be added to the room's history
+    messages, _ = history.get_page("batcave")
+    assert [(m["username"], m["message"]) for m in messages] == [("bruce.wayne", "I'm Batman.")]
+
+    # And it should be broadcast to the room
+    message = None
+    deadline = time.monotonic() + 0.5
+    while message is None and time.monotonic() < deadline:
+        message = pubsub.get_message(timeout=0.1)
+
+    event = json.loads(message["data"])
+    trace = event.pop("trace")
+    assert event == {
+        "id": event_id,
+        "type": "broadcast",
+        "args": ["batcave", "bruce.wayne", "I'm Batman."],
+    }
+
+    # And it should be stamped with when and where it was published
+    assert abs(trace["published_at"] - time.time()) < 1
+    assert trace["origin"] == registry.events.origin
+
+
+def test_rate_limited_messages_are_not_posted(app, load_component):
+    redis = load_component(Redis)
+    registry = load_component(ChatroomRegistry)
+    history = load_component(RoomHistory)
+
+    # Given a member that may only post a single message at a time
+    rate_limiter = RateLimiter(redis, {"message": {"user_rate": 0.1, "user_burst": 1}})
+    buckets = rate_limiter.get_buckets("message", "bruce.wayne", "batcave")
+
+    # When they post two messages back to back
+    first_id, _ = registry.post_message("batcave", "bruce.wayne", "I'm Batman.", history.max_length, buckets)
+    second_id, retry_after = registry.post_message("batcave", "bruce.wayne", "Really.", history.max_length, buckets)
+
+    # Then only the first one should be posted
+    assert first_id is not None
+    assert second_id is None
+    assert 0 < retry_after <= 10000
+
+    messages, _ = history.get_page("batcave")
+    assert [m["message"] for m in messages] == ["I'm Batman."]
+
+
+def test_registry_forgets_empty_rooms(app, load_component):
+    registry = load_component(ChatroomRegistry)
+    usage = registry.get_memory_usage()
+
+    # Given a socket that's a member of a couple of rooms
+    socket = object()
+    registry.add_member_to_room("batcave", socket, "bruce.wayne")
+    registry.add_member_to_room("wayne-manor", socket, "bruce.wayne")
+    joined_usage = registry.get_memory_usage()
+    assert joined_usage > usage
+
+    # When it looks up and leaves rooms it's not a member of
+    assert registry.get_sockets("arkham") == []
+    with pytest.raises(KeyError):
+        registry.remove_member_from_room("arkham", socket)
+
+    # Then those rooms should not be tracked
+    assert "arkham" not in registry.rooms
+
+    # When it leaves one of its rooms
+    registry.remove_member_from_room("batcave", socket)
+
+    # Then that room should be dropped
+    assert "batcave" not in registry.rooms
+    assert registry.connections[socket].rooms == {"wayne-manor"}
+
+    # When it disconnects
+    assert registry.remove_member_from_all_rooms(socket) == ["wayne-manor"]
+
+    # Then nothing should be left behind
+    assert "wayne-manor" not in registry.rooms
+    assert socket not in registry.connections
+    assert registry.get_memory_usage() < joined_usage
+
+
+def test_broadcasts_share_member_snapshots(app, load_component):
+    registry = load_component(ChatroomRegistry)
+
+    class Socket:
+        def __init__(self):
+            self.messages = []
+
+        def send(self, message):
+            self.messages.append(message)
+
+    # Given a room with a couple of members
+    first, second = Socket(), Socket()
+    registry.add_member_to_room("batcave", first, "bruce.wayne")
+    registry.add_member_to_room("batcave", second, "alfred.pennyworth")
+    snapshot = registry.get_snapshot("batcave")
+    assert snapshot == ((first, "full"), (second, "full"))
+
+    # When messages are broadcast to it
+    registry.send_to_all("batcave", EventMessage(type="pong"))
+    registry.send_to_all("batcave", EventMessage(type="pong"))
+
+    # Then every member should get them
+    assert len(first.messages) == len(second.messages) == 2
+
+    # And the snapshot should not be rebuilt
+    assert registry.get_snapshot("batcave") is snapshot
+
+    # When one of the members leaves
+    registry.remove_member_from_room("batcave", second)
+
+    # Then the room should get a new snapshot
+    assert registry.get_snapshot("batcave") == ((first, "full"),)
+    registry.remove_member_from_all_rooms(first)
+
+
+def test_failed_sends_leave_cleanup_to_the_connection(app, load_component):
+    registry = load_component(ChatroomRegistry)
+
+    class Socket:
+        def __init__(self, closed=False):
+            self.closed = closed
+            self.messages = []
+
+        def send(self, message):
+            if self.closed:
+                raise OSError("Outbox already closed.")
+            self.messages.append(message)
+
+    # Given a room with a member whose connection is going away
+    closing, open_ = Socket(closed=True), Socket()
+    registry.add_member_to_room("gotham-sewers", closing, "killer.croc")
+    registry.add_member_to_room("gotham-sewers", open_, "bruce.wayne")
+
+    # When messages are broadcast to the room
+    failures = SEND_TO_ALL_FAILURES.value
+    registry.send_to_all("gotham-sewers", EventMessage(type="pong"))
+    registry.send_presence("gotham-sewers", {"full": lambda: EventMessage(type="presence", usernames=[])})
+
+    # Then the other members should still get them
+    assert len(open_.messages) == 2
+
+    # And the failures should be counted
+    assert SEND_TO_ALL_FAILURES.value == failures + 2
+
+    # And the failing member should be left for its connection to clean up
+    assert registry.remove_member_from_all_rooms(closing) == ["gotham-sewers"]
+    registry.remove_member_from_all_rooms(open_)
@@ -0,0 +1,27 @@
+from chat.components.chatrooms import ChatroomRegistry
+from chat.components.history import RoomHistory
+from chat.components.redis import Redis
+
+
+def test_history_pages(app, load_component):
+    redis = load_component(Redis)
+    registry = load_component(ChatroomRegistry)
+
+    # Given a room history with a few messages in it
+    history = RoomHistory(redis, max_length=100, page_size=2)
+    for message in ["a", "b", "c"]:
+        registry.post_message("arkham", "jim.gordon", message, history.max_length)
+
+    # When I get the latest page
+    messages, cursor = history.get_page("arkham")
+
+    # Then I should get back the most recent messages, oldest first
+    assert [m["message"] for m in messages] == ["b", "c"]
+    assert cursor == messages[0]["id"]
+
+    # When I get the previous page
+    messages, cursor = history.get_page("arkham", cursor)
+
+    # Then I should get back the remaining message
+    assert [m["message"] for m in messages] == ["a"]
+    assert cursor is None
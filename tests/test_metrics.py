@@ -0,0 +1,57 @@
+import json
+import re
+
+from molten.contrib.websockets import TextMessage
+
+from chat.components.chatrooms import EVENT_HANDLING_SECONDS
+from chat.metrics import Metrics
+
+
+def test_histograms_render_cumulative_buckets():
+    # Given a histogram with a couple of observations
+    metrics = Metrics()
+    histogram = metrics.histogram("latency_seconds", "Latency.", label="type", values=["a"], buckets=(0.1, 1.0))
+    histogram.labels("a").observe(0.05)
+    histogram.labels("a").observe(0.5)
+
+    # When I render the metrics
+    output = metrics.render()
+
+    # Then the buckets should be cumulative
+    assert output == "\n".join([
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{type="a",le="0.1"} 1',
+        'latency_seconds_bucket{type="a",le="1.0"} 2',
+        'latency_seconds_bucket{type="a",le="+Inf"} 2',
+        'latency_seconds_sum{type="a"} 0.55',
+        'latency_seconds_count{type="a"} 2',
+    ]) + "\n"
+
+
+def test_metrics_endpoint(app, account, account_auth, client, client_ws):
+    # Metrics are per worker so earlier tests count towards them
+    joins_before = sum(EVENT_HANDLING_SECONDS.labels("join").counts)
+
+    # Given that I'm connected to a room
+    with client_ws.connect(app.reverse_uri("v1:chat:chat"), auth=account_auth) as sock:
+        sock.send(TextMessage(json.dumps({"type": "join", "room_name": "metrics"})))
+        sock.receive(timeout=1)
+
+        # When I request the metrics
+        response = client.get("/_metrics")
+
+        # Then I should get back the worker's metrics in the Prometheus format
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "chat_sockets 1" in response.data
+        assert "chat_rooms 1" in response.data
+        assert f'chat_event_handling_seconds_count{{type="join"}} {joins_before + 1}\n' in response.data
+        assert 'chat_redis_command_seconds_bucket{command="PIPELINE",le="+Inf"}' in response.data
+        assert "chat_listener_backlog_bytes 0" in response.data
+
+        # And script calls should be timed by script
+        pattern = r'chat_redis_command_seconds_count\{command="EVALSHA take_tokens"\} (\d+)'
+        [take_tokens_count] = re.findall(pattern, response.data)
+        assert int(take_tokens_count) > 0
+        assert 'chat_redis_command_seconds_count{command="EVALSHA"} 0\n' in response.data
@@ -0,0 +1,31 @@
+from chat.components.ratelimits import RateLimiter
+from chat.components.redis import Redis
+
+
+def test_events_are_throttled_per_user_and_room(app, load_component):
+    redis = load_component(Redis)
+
+    # Given a rate limiter that allows two messages per user and three per room
+    rate_limiter = RateLimiter(redis, {
+        "message": {"user_rate": 0.1, "user_burst": 2, "room_rate": 0.1, "room_burst": 3},
+    })
+
+    # When a user sends two messages to a room
+    # Then they should both go through
+    assert rate_limiter.check("message", "jim.gordon", "gotham") == 0
+    assert rate_limiter.check("message", "jim.gordon", "gotham") == 0
+
+    # When they send a third message
+    # Then they should be told when to try again
+    assert 0 < rate_limiter.check("message", "jim.gordon", "gotham") <= 10000
+
+    # When someone else sends two messages to the same room
+    # Then only the first one should fit in the room's bucket
+    assert rate_limiter.check("message", "bruce.wayne", "gotham") == 0
+    assert rate_limiter.check("message", "bruce.wayne", "gotham") > 0
+
+    # And they should still be able to send messages to other rooms
+    assert rate_limiter.check("message", "bruce.wayne", "batcave") == 0
+
+    # And event types without limits should never be throttled
+    assert rate_limiter.check("ping", "jim.gordon", "gotham") == 0
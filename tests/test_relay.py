@@ -0,0 +1,106 @@
+import logging
+import time
+
+import gevent
+from gevent import Timeout
+
+from chat.components import chatrooms
+from chat.components.chatrooms import ChatroomListener
+from chat.components.redis import Redis
+from chat.relay import Relay, RelaySubscriber
+
+
+def test_relay_shares_a_single_subscription(app, load_component, tmpdir):
+    redis = load_component(Redis)
+    path = str(tmpdir.join("relay.sock"))
+
+    # Given a relay with two workers connected to it
+    relay = Relay(redis, path)
+    relay.start()
+    try:
+        workers = [RelaySubscriber(path), RelaySubscriber(path)]
+        for worker in workers:
+            worker.connect()
+
+        def read_message(worker):
+            with Timeout(1):
+                return worker.get_message()
+
+        # When both of them subscribe to a room
+        for worker in workers:
+            worker.subscribe("chat:events:bat-signal")
+
+        # Then both should be told once Redis confirms the subscription
+        for worker in workers:
+            assert read_message(worker) == {"type": "subscribe", "channel": b"chat:events:bat-signal"}
+
+        # And Redis should only see the relay's subscription
+        assert redis.pubsub_numsub("chat:events:bat-signal") == [(b"chat:events:bat-signal", 1)]
+
+        # When an event is published to the room
+        redis.publish("chat:events:bat-signal", '{"type": "join"}')
+
+        # Then it should be forwarded to both workers
+        for worker in workers:
+            assert read_message(worker) == {
+                "type": "message",
+                "channel": b"chat:events:bat-signal",
+                "data": b'{"type": "join"}',
+            }
+
+        # When both of them unsubscribe
+        for worker in workers:
+            worker.unsubscribe("chat:events:bat-signal")
+            worker.close()
+
+        # Then the relay should drop its subscription
+        with Timeout(1):
+            while redis.pubsub_numsub("chat:events:bat-signal") != [(b"chat:events:bat-signal", 0)]:
+                gevent.sleep(0.01)
+    finally:
+        relay.stop()
+
+
+class StubRegistry:
+    def add_listener(self, listener):
+        pass
+
+
+def test_listener_backs_off_while_the_relay_is_down(app, load_component, tmpdir, caplog, monkeypatch):
+    redis = load_component(Redis)
+    path = str(tmpdir.join("relay.sock"))
+    caplog.set_level(logging.INFO)
+    monkeypatch.setattr(chatrooms, "RETRY_DELAY_MIN", 0.01)
+    monkeypatch.setattr(chatrooms, "RETRY_DELAY_MAX", 0.05)
+
+    # Given a listener whose relay isn't running
+    listener = ChatroomListener(RelaySubscriber(path), StubRegistry())
+    try:
+        gevent.sleep(0.3)
+
+        # Then the outage should only be logged once
+        failures = [record for record in caplog.records if record.levelno == logging.ERROR]
+        assert len(failures) == 1
+
+        # When a room is opened
+        started_at = time.monotonic()
+        listener.room_opened("arkham")
+
+        # Then it shouldn't wait for the subscription to be acknowledged
+        assert time.monotonic() - started_at < 1
+
+        # When the relay comes up
+        relay = Relay(redis, path)
+        relay.start()
+        try:
+            # Then the listener should reconnect and subscribe to the room
+            with Timeout(1):
+                while redis.pubsub_numsub("chat:events:arkham") != [(b"chat:events:arkham", 1)]:
+                    gevent.sleep(0.01)
+
+            # And its recovery should be logged
+            assert any(record.getMessage().startswith("Subscriber recovered") for record in caplog.records)
+        finally:
+            relay.stop()
+    finally:
+        listener.listener.kill()
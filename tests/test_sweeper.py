@@ -0,0 +1,73 @@
+import json
+import time
+
+from chat.components.chatrooms import ChatroomRegistry
+from chat.components.redis import Redis
+from chat.components.sweeper import PresenceSweeper
+
+
+def without_trace(event):
+    event.pop("trace", None)
+    return event
+
+
+def test_sweeper_removes_expired_members(app, load_component):
+    redis = load_component(Redis)
+    sweeper = load_component(PresenceSweeper)
+
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("chat:events:arkham")
+
+    # Given a room with an active member and one whose heartbeat expired
+    now = int(time.time())
+    redis.zadd("chat:rooms:arkham", now, "jim.gordon", now - 3600, "harvey.dent")
+    redis.zadd("chat:roster:arkham", 0, "jim.gordon", 0, "harvey.dent")
+    redis.sadd("chat:active_rooms", "arkham")
+
+    # And a room whose only member's heartbeat expired
+    redis.zadd("chat:rooms:batcave", now - 3600, "bruce.wayne")
+    redis.sadd("chat:active_rooms", "batcave")
+
+    # When the leader sweeps the rooms
+    assert sweeper.is_leader()
+    sweeper.sweep()
+
+    # Then expired members should be removed from their rooms
+    assert redis.zrange("chat:rooms:arkham", 0, -1) == [b"jim.gordon"]
+    assert redis.zrange("chat:roster:arkham", 0, -1) == [b"jim.gordon"]
+    assert not redis.exists("chat:rooms:batcave")
+
+    # And empty rooms should no longer be considered active
+    assert redis.smembers("chat:active_rooms") == {b"arkham"}
+
+    # And a leave event should be published for every expired member
+    events = []
+    deadline = time.monotonic() + 0.5
+    while time.monotonic() < deadline:
+        message = pubsub.get_message(timeout=0.1)
+        if message is not None:
+            events.append(without_trace(json.loads(message["data"])))
+
+    assert {"id": 1, "type": "leave", "args": ["arkham", "harvey.dent"]} in events
+
+
+def test_swept_members_leave_once(app, load_component):
+    redis = load_component(Redis)
+    registry = load_component(ChatroomRegistry)
+    sweeper = load_component(PresenceSweeper)
+
+    # Given a member whose heartbeat expired while their socket was still open
+    now = int(time.time())
+    redis.zadd("chat:rooms:blackgate", now - 3600, "harvey.dent")
+    redis.hset("chat:connections:blackgate", "harvey.dent", 1)
+    redis.sadd("chat:active_rooms", "blackgate")
+
+    # When the leader sweeps the rooms
+    assert sweeper.is_leader()
+    sweeper.sweep()
+
+    # Then their connection count should be dropped
+    assert not redis.hexists("chat:connections:blackgate", "harvey.dent")
+
+    # And closing their socket later shouldn't make them leave a second time
+    assert not registry.release_connection("blackgate", "harvey.dent")
@@ -0,0 +1,256 @@
+import socket
+import time
+import zlib
+
+import gevent
+import msgpack
+import pytest
+from gevent.event import Event
+from molten.contrib.websockets import OP_BINARY, OP_CLOSE, PongMessage, WebsocketClosedError, _BufferedStream
+
+from chat.websockets import (
+    COUNTERS, DROP_CONNECTION, DROP_OLDEST, JSON_CODEC, MSGPACK_CODEC, PING_MESSAGE, RSV1, ChatWebsocket, Outbox,
+    TimerWheel, WireBatch, WireMessage, deflate, frame_header, negotiate_compression, negotiate_subprotocol
+)
+
+
+class StalledSocket:
+    def __init__(self):
+        self.closed = False
+        self.sent = []
+        self.stream = self
+        self.stream_closed = False
+        self.unstalled = Event()
+
+    def close(self):
+        self.stream_closed = True
+
+    def send(self, message):
+        self.unstalled.wait()
+        self.sent.append(message)
+
+
+class QuietSocket(StalledSocket):
+    def __init__(self):
+        super().__init__()
+        self.socket = self
+        self.unstalled.set()
+
+    def recv(self, n):
+        return b"\x8a\x00"
+
+
+class TricklingStream:
+    def __init__(self):
+        self.written = b""
+
+    def write(self, data):
+        for i in range(0, len(data), 16):
+            self.written += data[i:i + 16]
+            gevent.sleep()
+
+
+def test_outbox_drops_oldest_messages_when_full():
+    # Given an outbox whose client has stopped reading
+    socket = StalledSocket()
+    outbox = Outbox(socket, max_size=2, overflow_policy=DROP_OLDEST)
+    dropped_messages = COUNTERS.dropped_messages
+
+    # When more messages are queued than the outbox can hold
+    for message in range(4):
+        outbox.send(message)
+        gevent.sleep()
+
+    # Then the oldest queued message should have been dropped
+    assert COUNTERS.dropped_messages == dropped_messages + 1
+
+    # When the client catches up
+    socket.unstalled.set()
+    gevent.sleep(0.1)
+
+    # Then it should receive the first and most recent messages
+    assert socket.sent == [0, 2, 3]
+
+
+def test_outbox_drops_connections_when_full():
+    # Given an outbox whose client has stopped reading
+    socket = StalledSocket()
+    outbox = Outbox(socket, max_size=1, overflow_policy=DROP_CONNECTION)
+    dropped_connections = COUNTERS.dropped_connections
+
+    # When more messages are queued than the outbox can hold
+    outbox.send(0)
+    gevent.sleep()
+    outbox.send(1)
+
+    # Then the connection should be dropped
+    with pytest.raises(WebsocketClosedError):
+        outbox.send(2)
+
+    assert outbox.closed
+    assert socket.stream_closed
+    assert COUNTERS.dropped_connections == dropped_connections + 1
+
+
+def test_timer_wheel_pings_quiet_peers_and_drops_dead_ones():
+    # Given a connection being watched by a timer wheel
+    socket = QuietSocket()
+    outbox = Outbox(socket, max_size=8, overflow_policy=DROP_OLDEST)
+    timers = TimerWheel(tick=1, ping_interval=2, idle_timeout=4)
+    timers.turner.kill()
+    peer = timers.watch(outbox)
+    dead_peers = COUNTERS.dead_peers
+
+    # When the peer goes quiet for longer than the ping interval
+    peer.last_seen = time.monotonic() - 2
+    for _ in range(2):
+        timers.turn()
+    gevent.sleep(0.1)
+
+    # Then it should be pinged
+    assert socket.sent == [PING_MESSAGE]
+
+    # When it responds
+    socket.stream.socket.recv(2)
+    for _ in range(2):
+        timers.turn()
+
+    # Then it should be left alone
+    assert not outbox.closed
+
+    # When it stops responding for longer than the idle timeout
+    peer.last_seen = time.monotonic() - 4
+    for _ in range(len(timers.slots)):
+        timers.turn()
+
+    # Then it should be disconnected
+    assert outbox.closed
+    assert socket.stream_closed
+    assert COUNTERS.dead_peers == dead_peers + 1
+
+
+def test_subprotocols_are_negotiated():
+    assert negotiate_subprotocol("chat.msgpack, chat.json") == ("chat.msgpack", MSGPACK_CODEC)
+    assert negotiate_subprotocol("chat.xml, chat.json") == ("chat.json", JSON_CODEC)
+    assert negotiate_subprotocol("chat.xml") == (None, JSON_CODEC)
+    assert negotiate_subprotocol(None) == (None, JSON_CODEC)
+
+
+def test_compression_is_negotiated():
+    assert negotiate_compression("permessage-deflate; client_max_window_bits")
+    assert negotiate_compression("permessage-deflate; server_max_window_bits=10, permessage-deflate")
+    assert not negotiate_compression("permessage-deflate; server_max_window_bits=10")
+    assert not negotiate_compression("x-webkit-deflate-frame")
+    assert not negotiate_compression(None)
+
+
+def test_compressed_msgpack_messages_are_exchanged():
+    # Given a websocket that negotiated compressed MessagePack
+    client_sock, server_sock = socket.socketpair()
+    websocket = ChatWebsocket(_BufferedStream(server_sock), MSGPACK_CODEC, compress=True)
+    client_stream = _BufferedStream(client_sock)
+
+    # When a large message is sent to it
+    usernames = [f"user-{i}" for i in range(100)]
+    websocket.send(WireMessage({"type": "presence", "usernames": usernames}))
+
+    # Then the client should receive a compressed binary frame
+    first_byte, second_byte = client_stream.expect(2)
+    assert first_byte & 0x0F == OP_BINARY
+    assert first_byte & RSV1 == RSV1
+
+    length = second_byte
+    if length == 126:
+        length = int.from_bytes(client_stream.expect(2), "big")
+
+    decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+    payload = decompressor.decompress(client_stream.expect(length) + b"\x00\x00\xff\xff")
+    assert msgpack.unpackb(payload, raw=False) == {"type": "presence", "usernames": usernames}
+
+    # When the client sends it a compressed message
+    payload = deflate(msgpack.packb({"type": "message", "message": "Hello!" * 100}, use_bin_type=True))
+    client_sock.sendall(frame_header(OP_BINARY, len(payload), RSV1) + payload)
+
+    # Then it should be decoded transparently
+    message = websocket.receive(timeout=1)
+    assert websocket.decode(message) == {"type": "message", "message": "Hello!" * 100}
+
+
+def test_outbox_batches_messages_within_the_window():
+    # Given an outbox with batching turned on
+    socket = QuietSocket()
+    outbox = Outbox(socket, max_size=8, overflow_policy=DROP_OLDEST, batch_window=0.05)
+
+    # When a burst of messages is queued up followed by a ping
+    messages = [WireMessage({"type": "broadcast", "message": str(i)}) for i in range(3)]
+    for message in messages:
+        outbox.send(message)
+    outbox.send(PING_MESSAGE)
+    gevent.sleep(0.1)
+
+    # Then the burst should be sent as a single batch ahead of the ping
+    [batch, ping] = socket.sent
+    assert isinstance(batch, WireBatch)
+    assert batch.data == messages
+    assert ping is PING_MESSAGE
+
+    # And the batch should be encoded as an array of its messages
+    assert JSON_CODEC.decode(batch.get_payload(JSON_CODEC)) == [message.data for message in messages]
+    assert MSGPACK_CODEC.decode(batch.get_payload(MSGPACK_CODEC)) == [message.data for message in messages]
+
+
+def test_websocket_writes_are_not_interleaved():
+    # Given a websocket whose writes block part of the way through
+    stream = TricklingStream()
+    websocket = ChatWebsocket(stream)
+
+    # When a pong is sent while a large message is being written
+    message = WireMessage({"type": "presence", "usernames": [f"user-{i}" for i in range(100)]})
+    writer = gevent.spawn(websocket.send, message)
+    gevent.sleep()
+    websocket.send(PongMessage(b"ping"))
+    writer.join()
+
+    # Then the pong should only be written after the message
+    assert stream.written == message.get_frame(JSON_CODEC, False) + b"\x8a\x04ping"
+
+
+def test_negotiated_extensions_are_sent_in_the_upgrade_response(app, account, account_auth, client):
+    # Given a client that offers compressed MessagePack
+    client_sock, server_sock = socket.socketpair()
+
+    def prepare_environ(environ):
+        environ["gunicorn.socket"] = server_sock
+        return environ
+
+    headers = {
+        "connection": "upgrade",
+        "upgrade": "websocket",
+        "sec-websocket-key": "YWFhYWFhYWFhYWFhYWFhYQ==",
+        "sec-websocket-version": "13",
+        "sec-websocket-protocol": "chat.msgpack",
+        "sec-websocket-extensions": "permessage-deflate",
+    }
+
+    # When it connects
+    request = gevent.spawn(
+        client.get, app.reverse_uri("v1:chat:chat"), headers=headers, auth=account_auth,
+        prepare_environ=prepare_environ,
+    )
+    client_stream = _BufferedStream(client_sock)
+    response = b""
+    while not response.endswith(b"\r\n\r\n"):
+        response += client_stream.expect(1)
+
+    # Then the upgrade response should include what was negotiated
+    assert response.startswith(b"HTTP/1.1 101 Switching Protocols\r\n")
+    assert b"\r\nsec-websocket-protocol: chat.msgpack\r\n" in response
+    assert b"\r\nsec-websocket-extensions: permessage-deflate; server_no_context_takeover\r\n" in response
+
+    # When it closes the connection
+    client_sock.sendall(frame_header(OP_CLOSE, 0))
+    request.join(timeout=5)
+
+    # Then the server should send back a single close frame
+    assert client_stream.read(100) == b"\x88\x02\x03\xe8"
+    assert request.ready()